@@ -1,11 +1,33 @@
 import os
+import asyncio
+import contextvars
+import threading
+import hmac
+import ipaddress
+import functools
+import heapq
+import itertools
+import re
+import signal
+import sqlite3
+import time
+import uuid
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_values
 import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from PIL import Image, ImageDraw, ImageFont
 import io
-from telegram import Update
-from telegram.ext import Application, CommandHandler, CallbackContext, MessageHandler, filters
+import csv
+import json
+import tempfile
+from telegram import ChatMember, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, ApplicationHandlerStop, CallbackQueryHandler, ChatMemberHandler, CommandHandler, CallbackContext, ContextTypes, MessageHandler, TypeHandler, filters
 import urllib.parse as urlparse
 
 # Настройка логирования
@@ -21,36 +43,499 @@ YOUR_USER_ID = int(os.getenv('YOUR_USER_ID', '7892045071'))
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN не установлен!")
 
+# 🌐 РЕЖИМ ПОЛУЧЕНИЯ ОБНОВЛЕНИЙ: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Публичный адрес для setWebhook; без него бот только слушает порт
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Обязателен, если webhook слушает не только loopback
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+# Адрес Bot API, например локальной заглушки для проверки без Telegram
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# 📈 МЕТРИКИ
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOP_LAG_INTERVAL = 0.5
+
+class Metrics:
+    """Счетчики, гистограммы и значения в текстовом формате Prometheus.
+    
+    Пишут в них и цикл событий, и потоки БД, поэтому обновления под замком.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.descriptions = {}
+
+    def describe(self, name, text):
+        self.descriptions[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, (list(b), s, c)) for key, (b, s, c) in self.histograms.items())
+        
+        lines = []
+        declared = set()
+        
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if name in self.descriptions:
+                    lines.append(f"# HELP {name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            declare(name, 'gauge')
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            declare(name, 'histogram')
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+metrics = Metrics()
+metrics.describe('bot_command_duration_seconds', "Время обработки команды")
+metrics.describe('bot_commands_total', "Обработанные команды по результату")
+metrics.describe('db_query_duration_seconds', "Время выполнения запроса к БД")
+metrics.describe('db_queries_total', "Запросы к БД по результату")
+metrics.describe('db_connections_opened_total', "Открытые соединения с БД")
+metrics.describe('db_reconnects_total', "Переподключения к БД")
+metrics.describe('db_available', "1 — БД доступна, 0 — идет переподключение")
+metrics.describe('event_loop_lag_seconds', "Задержка цикла событий")
+metrics.describe('bot_messages_sent_total', "Отправленные сообщения бота")
+metrics.describe('bot_send_retries_total', "Повторы отправки по причине")
+metrics.describe('bot_send_failures_total', "Сообщения, которые не удалось отправить")
+metrics.describe('db_replica_lag_seconds', "Отставание реплики для чтения")
+metrics.describe('db_replica_available', "1 — чтения идут на реплику, 0 — на основную БД")
+
 # 🔗 ПОДКЛЮЧЕНИЕ К POSTGRESQL
-def get_connection():
-    """Получить соединение с PostgreSQL"""
-    database_url = os.getenv('DATABASE_URL')
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_KEEPALIVE_INTERVAL = float(os.getenv('DB_KEEPALIVE_INTERVAL', '30'))
+DB_VALIDATE_IDLE = float(os.getenv('DB_VALIDATE_IDLE', '60'))
+DB_RECONNECT_MIN = float(os.getenv('DB_RECONNECT_MIN', '1'))
+DB_RECONNECT_MAX = float(os.getenv('DB_RECONNECT_MAX', '60'))
+DB_OUTAGE_WAIT = float(os.getenv('DB_OUTAGE_WAIT', '0'))
+# Без таймаута подключение к недоступному хосту висит до таймаута TCP в ОС
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+# Локальному Postgres без SSL (например, для bench.py) нужен DB_SSLMODE=disable
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+# Необязательная реплика для команд, которые только читают
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL')
+DB_READ_POOL_MAX = int(os.getenv('DB_READ_POOL_MAX', str(DB_POOL_MAX)))
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+# Столько секунд после своей записи пользователь читает с основной БД
+DB_READ_YOUR_WRITES = float(os.getenv('DB_READ_YOUR_WRITES', '30'))
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, помнящее время последнего использования"""
+    last_used = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        metrics.inc('db_connections_opened_total')
+
+def get_connection_params(database_url=None):
+    """Параметры подключения к PostgreSQL из DATABASE_URL или из URL реплики"""
+    database_url = database_url or DATABASE_URL
     if not database_url:
         raise ValueError("❌ DATABASE_URL не установлен!")
     
     # Парсим URL для Railway
     url = urlparse.urlparse(database_url)
-    dbname = url.path[1:]
-    user = url.username
-    password = url.password
-    host = url.hostname
-    port = url.port
-    
-    return psycopg2.connect(
-        dbname=dbname,
-        user=user,
-        password=password,
-        host=host,
-        port=port,
-        sslmode='require'
+    return dict(
+        dbname=url.path[1:],
+        user=url.username,
+        password=url.password,
+        host=url.hostname,
+        port=url.port,
+        sslmode=DB_SSLMODE,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        # TCP keepalive не дает NAT/прокси молча оборвать простаивающие соединения
+        keepalives=1,
+        keepalives_idle=int(DB_KEEPALIVE_INTERVAL),
+        keepalives_interval=10,
+        keepalives_count=3,
+        connection_factory=PooledConnection
     )
 
-# Глобальное соединение
-conn = get_connection()
-cursor = conn.cursor()
+def get_connection():
+    """Получить соединение с PostgreSQL"""
+    return psycopg2.connect(**get_connection_params())
+
+# 🏊 ПУЛ СОЕДИНЕНИЙ
+# Запросы выполняются в потоках db_executor, каждый на своем соединении из пула,
+# поэтому медленный запрос не блокирует цикл событий и другие чаты.
+db_pool = None
+db_pool_lock = threading.Lock()
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix='db')
+db_slots = None
+# Реплика — свой пул, свои потоки и свои слоты, чтобы чтения не отнимали их у записей
+db_read_pool = None
+db_read_executor = ThreadPoolExecutor(max_workers=DB_READ_POOL_MAX, thread_name_prefix='db-read') if DATABASE_READ_URL else None
+db_read_slots = None
+db_last_success = 0.0
+
+# Состояние БД ведет db_health_loop; обработчики его только читают
+db_available = asyncio.Event()
+db_available.set()
+db_check_now = asyncio.Event()
+# Выставляет prepare_db, когда миграции применены
+db_ready = asyncio.Event()
+
+class DatabaseBusy(Exception):
+    """Все соединения пула заняты дольше DB_POOL_TIMEOUT"""
+
+class DatabaseUnavailable(Exception):
+    """БД недоступна, идет переподключение в фоне"""
+
+class CommitUnknown(psycopg2.OperationalError):
+    """Соединение оборвалось на COMMIT: дошла ли запись до базы — неизвестно"""
+
+# Ошибки соединения: запрос не выполнился (кроме CommitUnknown — там исход неизвестен)
+DB_OUTAGE_ERRORS = (DatabaseUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError)
+
+def get_pool(readonly=False):
+    """Пул соединений (основной или реплики) создается при первом обращении"""
+    global db_pool, db_read_pool
+    with db_pool_lock:
+        if readonly:
+            if db_read_pool is None:
+                db_read_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_READ_POOL_MAX, **get_connection_params(DATABASE_READ_URL)
+                )
+            return db_read_pool
+        if db_pool is None:
+            db_pool = pg_pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **get_connection_params())
+        return db_pool
+
+def close_pool(readonly=False):
+    """Закрыть все соединения пула"""
+    global db_pool, db_read_pool
+    with db_pool_lock:
+        if readonly:
+            if db_read_pool is not None:
+                db_read_pool.closeall()
+                db_read_pool = None
+        elif db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+
+def ensure_connection(conn):
+    """Проверить соединение из пула; SELECT 1 только после долгого простоя"""
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_VALIDATE_IDLE:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def borrow_connection(readonly=False):
+    """Взять соединение из пула: commit при успехе, rollback при ошибке"""
+    global db_last_success
+    pool = get_pool(readonly)
+    conn = pool.getconn()
+    if not ensure_connection(conn):
+        print("🔁 Восстанавливаем соединение с БД...")
+        metrics.inc('db_reconnects_total', (('reason', 'validation'),))
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    try:
+        yield conn
+        try:
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            raise CommitUnknown(str(e)) from e
+        conn.last_used = time.monotonic()
+        if not readonly:
+            db_last_success = conn.last_used
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Пул мог быть закрыт переподключением, пока соединение было занято
+        if not pool.closed:
+            pool.putconn(conn, close=bool(conn.closed))
+
+def query_label(func, args):
+    """Метка запроса для метрик: текст SQL для db_fetch*/db_execute, иначе имя функции"""
+    if func in (_fetchone, _fetchall, _execute):
+        return ' '.join(args[0].split())[:100]
+    return func.__name__
+
+def _run_in_connection(func, args, readonly=False):
+    labels = (('query', query_label(func, args)), ('pool', 'replica' if readonly else 'primary'))
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        with borrow_connection(readonly) as conn:
+            with conn.cursor() as cursor:
+                result = func(cursor, *args)
+        status = 'ok'
+        return result
+    finally:
+        metrics.observe('db_query_duration_seconds', time.perf_counter() - started, labels)
+        metrics.inc('db_queries_total', labels + (('status', status),))
+
+async def _db_submit(func, args, readonly=False):
+    global db_slots, db_read_slots
+    if readonly:
+        if db_read_slots is None:
+            db_read_slots = asyncio.Semaphore(DB_READ_POOL_MAX)
+        slots, executor = db_read_slots, db_read_executor
+    else:
+        if db_slots is None:
+            db_slots = asyncio.Semaphore(DB_POOL_MAX)
+        slots, executor = db_slots, db_executor
+    try:
+        await asyncio.wait_for(slots.acquire(), DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise DatabaseBusy(f"нет свободных соединений за {DB_POOL_TIMEOUT} с")
+    
+    loop = asyncio.get_running_loop()
+    # Слот освобождается, только когда поток действительно вернул соединение
+    future = executor.submit(_run_in_connection, func, args, readonly)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(slots.release))
+    return await asyncio.wrap_future(future)
+
+# 📖 РЕПЛИКА ДЛЯ ЧТЕНИЯ
+# Запросы с readonly=True идут на реплику, пока она отвечает и отстает не больше
+# DB_REPLICA_MAX_LAG. Пользователь, который только что писал (db_caller выставляет
+# resolve_caller), DB_READ_YOUR_WRITES секунд читает с основной БД и видит свои изменения.
+replica_ok = False
+db_caller = contextvars.ContextVar('db_caller', default=None)
+last_writes = {}
+
+def use_replica():
+    if not replica_ok:
+        return False
+    written = last_writes.get(db_caller.get())
+    return written is None or time.monotonic() - written > DB_READ_YOUR_WRITES
+
+async def db_run(func, *args, readonly=False, write=False):
+    """Выполнить func(cursor, *args) в потоке пула и дождаться результата.
+    
+    readonly=True — запрос только читает и может уйти на реплику.
+    write=True — запрос меняет данные: автор Update DB_READ_YOUR_WRITES секунд
+    читает с основной БД. Чтения с основной БД (кэш ролей, справочник) так не помечаются.
+    """
+    global replica_ok
+    if not db_ready.is_set():
+        # Сразу после старта схема может быть еще не готова
+        try:
+            await asyncio.wait_for(db_ready.wait(), DB_READY_WAIT)
+        except asyncio.TimeoutError:
+            raise DatabaseUnavailable("база данных еще не готова")
+    if readonly and use_replica():
+        try:
+            return await _db_submit(func, args, readonly=True)
+        except DatabaseBusy:
+            # Пул реплики занят — этот запрос выполнит основная БД
+            pass
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError) as e:
+            # До следующей проверки replica_monitor_loop все чтения идут на основную БД
+            logging.warning("⚠️ Реплика не отвечает, читаем с основной БД: %s", e)
+            replica_ok = False
+            metrics.set('db_replica_available', 0)
+    if not db_available.is_set():
+        # Во время сбоя не ждем переподключения, а сразу отказываем (или ждем DB_OUTAGE_WAIT)
+        try:
+            await asyncio.wait_for(db_available.wait(), DB_OUTAGE_WAIT)
+        except asyncio.TimeoutError:
+            raise DatabaseUnavailable("база данных временно недоступна")
+    try:
+        result = await _db_submit(func, args)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError):
+        db_check_now.set()
+        raise
+    if write and db_caller.get() is not None:
+        last_writes[db_caller.get()] = time.monotonic()
+    return result
+
+def _ping(cursor):
+    cursor.execute("SELECT 1")
+
+def _ping_dedicated():
+    """SELECT 1 на отдельном соединении мимо пула"""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            _ping(cursor)
+    finally:
+        conn.close()
+
+async def db_health_loop():
+    """Фоновая проверка БД и переподключение с экспоненциальной задержкой"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await asyncio.wait_for(db_check_now.wait(), DB_KEEPALIVE_INTERVAL)
+            after_error = True
+        except asyncio.TimeoutError:
+            after_error = False
+        db_check_now.clear()
+        
+        # Под нагрузкой живость БД и так подтверждают обычные запросы,
+        # но после ошибки соединения проверяем сразу, не дожидаясь тишины
+        if not after_error and time.monotonic() - db_last_success < DB_KEEPALIVE_INTERVAL:
+            continue
+        try:
+            try:
+                await _db_submit(_ping, ())
+            except DatabaseBusy:
+                # Пул занят — это еще не значит, что БД жива: проверяем мимо пула
+                await asyncio.wait_for(loop.run_in_executor(None, _ping_dedicated), DB_CONNECT_TIMEOUT * 2)
+            continue
+        except (psycopg2.Error, asyncio.TimeoutError) as e:
+            logging.warning("⚠️ БД не отвечает: %s", str(e) or "таймаут проверки")
+        
+        db_available.clear()
+        metrics.set('db_available', 0)
+        delay = DB_RECONNECT_MIN
+        while True:
+            await loop.run_in_executor(None, close_pool)
+            try:
+                await loop.run_in_executor(None, _run_in_connection, _ping, ())
+                break
+            except psycopg2.Error as e:
+                print(f"🔁 БД недоступна ({e}), повтор через {delay:.0f} с")
+                metrics.inc('db_reconnects_total', (('reason', 'outage'),))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, DB_RECONNECT_MAX)
+        db_available.set()
+        metrics.set('db_available', 1)
+        print("✅ Соединение с БД восстановлено")
+
+# Реплика, догнавшая основную БД, не отстает, даже если записей давно не было
+REPLICA_LAG_QUERY = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+def _replica_lag(cursor):
+    cursor.execute(REPLICA_LAG_QUERY)
+    return float(cursor.fetchone()[0])
 
-def init_db():
-    """Инициализация таблиц в PostgreSQL"""
+async def replica_monitor_loop():
+    """Проверка отставания реплики; при сбое или отставании чтения идут на основную БД"""
+    global replica_ok
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            lag = await _db_submit(_replica_lag, (), readonly=True)
+            metrics.set('db_replica_lag_seconds', lag)
+            ok = lag <= DB_REPLICA_MAX_LAG
+            if not ok and replica_ok:
+                logging.warning("⚠️ Реплика отстает на %.1f с, читаем с основной БД", lag)
+        except DatabaseBusy:
+            ok = replica_ok
+        except (psycopg2.Error, pg_pool.PoolError) as e:
+            if replica_ok:
+                logging.warning("⚠️ Реплика недоступна, читаем с основной БД: %s", e)
+            ok = False
+            await loop.run_in_executor(None, close_pool, True)
+        if ok and not replica_ok:
+            print("📖 Чтения идут на реплику")
+        replica_ok = ok
+        metrics.set('db_replica_available', int(ok))
+        
+        # Отметки старше окна read-your-writes больше ни на что не влияют
+        cutoff = time.monotonic() - DB_READ_YOUR_WRITES
+        for user_id in [user_id for user_id, written in last_writes.items() if written < cutoff]:
+            del last_writes[user_id]
+        await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+def _fetchone(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchone()
+
+def _fetchall(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+def _execute(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.rowcount
+
+async def db_fetchone(query, params=(), readonly=False, write=False):
+    return await db_run(_fetchone, query, params, readonly=readonly, write=write)
+
+async def db_fetchall(query, params=(), readonly=False, write=False):
+    return await db_run(_fetchall, query, params, readonly=readonly, write=write)
+
+async def db_execute(query, params=()):
+    """Выполнить запрос, меняющий данные, и вернуть число затронутых строк"""
+    return await db_run(_execute, query, params, write=True)
+
+# 🗄️ МИГРАЦИИ СХЕМЫ
+# Каждая миграция выполняется один раз, номер записывается в schema_version.
+# Шаги написаны идемпотентно (IF NOT EXISTS), поэтому база, созданная до появления
+# schema_version, спокойно проходит их все заново. Новые изменения схемы —
+# только новой миграцией в конце MIGRATIONS.
+DB_READY_WAIT = float(os.getenv('DB_READY_WAIT', '30'))
+
+def _has_trgm(cursor):
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    return cursor.fetchone() is not None
+
+def _m001_base_tables(cursor):
+    """Таблицы скамеров, админов, банов, варнов и мутов"""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS scammers (
             id SERIAL PRIMARY KEY,
@@ -102,43 +587,1832 @@ def init_db():
             unmute_date TIMESTAMP,
             chat_id BIGINT
         )
-    ''')
-    # Добавляем владельца если его нет
-    cursor.execute("INSERT INTO admins (admin_id, username, role) VALUES (%s, %s, 'owner') ON CONFLICT (admin_id) DO NOTHING", (YOUR_USER_ID, 'owner'))
-    conn.commit()
+    ''')
+
+def _m002_username_indexes(cursor):
+    """Индексы по LOWER(username)"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS scammers_username_lower_idx ON scammers (LOWER(username))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS admins_username_lower_idx ON admins (LOWER(username))")
+
+def _m003_admins_notify(cursor):
+    """NOTIFY admins_changed при изменении admins"""
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION notify_admins_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('admins_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute("DROP TRIGGER IF EXISTS admins_changed ON admins")
+    cursor.execute('''
+        CREATE TRIGGER admins_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON admins
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_admins_changed()
+    ''')
+
+def _m004_moderation_indexes(cursor):
+    """Индексы банов, варнов и мутов по чату"""
+    # Варны и баны ищутся в пределах чата по username
+    cursor.execute("CREATE INDEX IF NOT EXISTS warns_chat_username_idx ON warns (chat_id, LOWER(username))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS bans_chat_username_idx ON bans (chat_id, LOWER(username))")
+    # Планировщик мутов при старте читает только муты со сроком
+    cursor.execute("CREATE INDEX IF NOT EXISTS mutes_pending_idx ON mutes (id) WHERE unmute_date IS NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS mutes_chat_username_idx ON mutes (chat_id, LOWER(username))")
+    # Постраничный /banlist идет по id внутри чата
+    cursor.execute("CREATE INDEX IF NOT EXISTS bans_chat_id_idx ON bans (chat_id, id)")
+
+def _m005_add_warn(cursor):
+    """Функция add_warn: варн и автобан одной операцией"""
+    # advisory lock не дает двум одновременным варнам одному пользователю
+    # проскочить мимо порога
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION add_warn(
+            p_user_id BIGINT, p_username TEXT, p_reason TEXT, p_warned_by BIGINT,
+            p_chat_id BIGINT, p_limit INTEGER, p_ban_reason TEXT
+        ) RETURNS TABLE (warn_count INTEGER, banned BOOLEAN) AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext(p_chat_id::text || ':' || LOWER(p_username)));
+            INSERT INTO warns (user_id, username, reason, warned_by, chat_id)
+            VALUES (p_user_id, p_username, p_reason, p_warned_by, p_chat_id);
+            SELECT COUNT(*) INTO warn_count FROM warns
+            WHERE chat_id = p_chat_id AND LOWER(username) = LOWER(p_username);
+            banned := warn_count >= p_limit;
+            IF banned THEN
+                INSERT INTO bans (user_id, username, reason, banned_by, chat_id)
+                VALUES (p_user_id, p_username, p_ban_reason, p_warned_by, p_chat_id);
+                DELETE FROM warns WHERE chat_id = p_chat_id AND LOWER(username) = LOWER(p_username);
+            END IF;
+            RETURN NEXT;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+
+def _m006_counters(cursor):
+    """Счетчики для /stats на триггерах"""
+    # Триггеры избавляют /stats от COUNT(*) по таблицам.
+    # chat_id = 0 — общий счетчик, иначе счетчик по чату.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT NOT NULL,
+            chat_id BIGINT NOT NULL DEFAULT 0,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, chat_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_counters() RETURNS trigger AS $$
+        DECLARE
+            delta BIGINT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+            row_chat BIGINT;
+        BEGIN
+            INSERT INTO counters (name, chat_id, value) VALUES (TG_TABLE_NAME, 0, delta)
+            ON CONFLICT (name, chat_id) DO UPDATE SET value = counters.value + EXCLUDED.value;
+            IF TG_NARGS > 0 THEN
+                IF TG_OP = 'INSERT' THEN
+                    row_chat := NEW.chat_id;
+                ELSE
+                    row_chat := OLD.chat_id;
+                END IF;
+                IF row_chat IS NOT NULL THEN
+                    INSERT INTO counters (name, chat_id, value) VALUES (TG_TABLE_NAME, row_chat, delta)
+                    ON CONFLICT (name, chat_id) DO UPDATE SET value = counters.value + EXCLUDED.value;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION reset_counters() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM counters WHERE name = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    counted_tables = {'scammers': False, 'admins': False, 'bans': True, 'warns': True, 'mutes': True}
+    # Пока пересоздаем триггеры и засеваем счетчики, записи в таблицы ждут
+    cursor.execute("LOCK TABLE scammers, admins, bans, warns, mutes IN SHARE ROW EXCLUSIVE MODE")
+    for table, per_chat in counted_tables.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_counters ON {table}")
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_counters_reset ON {table}")
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_counters AFTER INSERT OR DELETE ON {table}
+            FOR EACH ROW EXECUTE PROCEDURE bump_counters({"'per_chat'" if per_chat else ""})
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER {table}_counters_reset AFTER TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE PROCEDURE reset_counters()
+        ''')
+        # Один раз считаем то, что было в таблице до появления счетчиков
+        cursor.execute("SELECT 1 FROM counters WHERE name = %s LIMIT 1", (table,))
+        if cursor.fetchone() is None:
+            cursor.execute(f"INSERT INTO counters (name, chat_id, value) SELECT %s, 0, COUNT(*) FROM {table} HAVING COUNT(*) > 0", (table,))
+            if per_chat:
+                cursor.execute(f"INSERT INTO counters (name, chat_id, value) SELECT %s, chat_id, COUNT(*) FROM {table} WHERE chat_id IS NOT NULL GROUP BY chat_id", (table,))
+
+def _m007_fuzzy_search(cursor):
+    """Индекс для /check ~name"""
+    # Триграммный GIN-индекс, если pg_trgm можно подключить,
+    # иначе только поиск по префиксу через text_pattern_ops
+    cursor.execute("SAVEPOINT create_trgm")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("RELEASE SAVEPOINT create_trgm")
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT create_trgm")
+        print(f"⚠️ pg_trgm недоступен, /check ~name ищет только по префиксу: {e}")
+    if _has_trgm(cursor):
+        cursor.execute("CREATE INDEX IF NOT EXISTS scammers_username_trgm_idx ON scammers USING GIN (LOWER(username) gin_trgm_ops)")
+    else:
+        cursor.execute("CREATE INDEX IF NOT EXISTS scammers_username_prefix_idx ON scammers (LOWER(username) text_pattern_ops)")
+
+def _m008_user_directory(cursor):
+    """Справочник пользователей"""
+    # Кого и в каком чате бот видел последним
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            last_seen TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (LOWER(username))")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_members (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            last_seen TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+def _m009_chats(cursor):
+    """Настройки чатов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            screening TEXT NOT NULL DEFAULT 'off'
+        )
+    ''')
+
+def _m010_bans_username_index(cursor):
+    """Индекс банов по username для /unban"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS bans_username_idx ON bans (username)")
+
+def _m011_global_bans(cursor):
+    """Статус бота в чатах и глобальные баны"""
+    # Статус бота приходит в my_chat_member; can_ban — админ с правом банить
+    cursor.execute("ALTER TABLE chats ADD COLUMN IF NOT EXISTS bot_status TEXT")
+    cursor.execute("ALTER TABLE chats ADD COLUMN IF NOT EXISTS can_ban BOOLEAN NOT NULL DEFAULT FALSE")
+    cursor.execute("ALTER TABLE chats ADD COLUMN IF NOT EXISTS status_updated TIMESTAMP")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS global_bans (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username TEXT,
+            reason TEXT,
+            banned_by BIGINT,
+            chat_id BIGINT,
+            progress_message_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    # Чекпоинт рассылки: строка на каждый чат, pending -> done/failed
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS global_ban_chats (
+            ban_id INTEGER NOT NULL REFERENCES global_bans (id) ON DELETE CASCADE,
+            chat_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (ban_id, chat_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS global_ban_chats_pending_idx ON global_ban_chats (ban_id, chat_id) WHERE status = 'pending'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS global_bans_unfinished_idx ON global_bans (id) WHERE finished_at IS NULL")
+
+def _m012_journal_applied(cursor):
+    """Примененные записи локального журнала"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS journal_applied (
+            op_id TEXT PRIMARY KEY,
+            op TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _m013_statement_counters(cursor):
+    """Счетчики на триггерах уровня оператора"""
+    # Построчный триггер обновлял одну и ту же строку counters на каждую вставленную
+    # строку: пачка из 20k строк шла секунды. Теперь один upsert на оператор, по
+    # таблице переходов changed. Событие у триггера с таблицей переходов может быть
+    # только одно, поэтому INSERT и DELETE — отдельные триггеры.
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_counters_batch() RETURNS trigger AS $$
+        DECLARE
+            delta BIGINT := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+        BEGIN
+            INSERT INTO counters (name, chat_id, value)
+            SELECT TG_TABLE_NAME, 0, delta * COUNT(*) FROM changed HAVING COUNT(*) > 0
+            ON CONFLICT (name, chat_id) DO UPDATE SET value = counters.value + EXCLUDED.value;
+            IF TG_NARGS > 0 THEN
+                -- Строки чатов в одном порядке: параллельные пачки не ловят deadlock
+                INSERT INTO counters (name, chat_id, value)
+                SELECT TG_TABLE_NAME, chat_id, delta * COUNT(*) FROM changed
+                WHERE chat_id IS NOT NULL GROUP BY chat_id ORDER BY chat_id
+                ON CONFLICT (name, chat_id) DO UPDATE SET value = counters.value + EXCLUDED.value;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    counted_tables = {'scammers': False, 'admins': False, 'bans': True, 'warns': True, 'mutes': True}
+    cursor.execute("LOCK TABLE scammers, admins, bans, warns, mutes IN SHARE ROW EXCLUSIVE MODE")
+    for table, per_chat in counted_tables.items():
+        args = "'per_chat'" if per_chat else ""
+        cursor.execute(f"DROP TRIGGER IF EXISTS {table}_counters ON {table}")
+        for event, transition in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+            name = f"{table}_counters_{event.lower()}"
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+            cursor.execute(f'''
+                CREATE TRIGGER {name} AFTER {event} ON {table}
+                REFERENCING {transition} TABLE AS changed
+                FOR EACH STATEMENT EXECUTE PROCEDURE bump_counters_batch({args})
+            ''')
+    cursor.execute("DROP FUNCTION IF EXISTS bump_counters()")
+
+MIGRATIONS = [
+    (1, _m001_base_tables),
+    (2, _m002_username_indexes),
+    (3, _m003_admins_notify),
+    (4, _m004_moderation_indexes),
+    (5, _m005_add_warn),
+    (6, _m006_counters),
+    (7, _m007_fuzzy_search),
+    (8, _m008_user_directory),
+    (9, _m009_chats),
+    (10, _m010_bans_username_index),
+    (11, _m011_global_bans),
+    (12, _m012_journal_applied),
+    (13, _m013_statement_counters),
+]
+
+def _migrate(cursor):
+    """Применить недостающие миграции одной транзакцией; вернуть их номера"""
+    global trgm_available
+    # Несколько процессов при деплое: мигрирует первый, остальные ждут и видят готовую схему
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current = cursor.fetchone()[0]
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version > current:
+            migration(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, migration.__doc__))
+            applied.append(version)
+    # Добавляем владельца если его нет
+    cursor.execute("INSERT INTO admins (admin_id, username, role) VALUES (%s, %s, 'owner') ON CONFLICT (admin_id) DO NOTHING", (YOUR_USER_ID, 'owner'))
+    trgm_available = _has_trgm(cursor)
+    return applied
+
+async def prepare_db():
+    """Миграции и прогрев пула в фоне после старта; до конца обработчики ждут db_ready"""
+    delay = DB_RECONNECT_MIN
+    while True:
+        try:
+            applied = await _db_submit(_migrate, ())
+            break
+        except (psycopg2.Error, DatabaseBusy) as e:
+            print(f"🔁 База данных не готова ({e}), повтор через {delay:.0f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_RECONNECT_MAX)
+    if applied:
+        print(f"📊 Применены миграции: {', '.join(map(str, applied))}")
+    db_ready.set()
+    print("📊 База данных готова")
+
+# 👮 КЭШ РОЛЕЙ
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', '300'))
+ROLE_LISTEN_RETRY = float(os.getenv('ROLE_LISTEN_RETRY', '5'))
+
+class RoleCache:
+    """Вся таблица admins в памяти: перечитывается по TTL или после изменений"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.admins = {}
+        self.by_username = {}
+        self.loaded_at = None
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.generation += 1
+        self.loaded_at = None
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    async def refresh(self):
+        async with self.lock:
+            if self.is_fresh():
+                return
+            generation = self.generation
+            try:
+                rows = await db_fetchall("SELECT admin_id, username, role FROM admins")
+            except DB_OUTAGE_ERRORS:
+                # Во время сбоя — роли из снимка; кэш остается несвежим и перечитается из базы
+                rows = await local_snapshot.admins() if local_snapshot else None
+                if rows is None:
+                    raise
+                generation = None
+            self.admins = {admin_id: (username, role) for admin_id, username, role in rows}
+            self.by_username = {
+                username.lower(): (admin_id, username, role)
+                for admin_id, username, role in rows if username
+            }
+            # Если пока читали пришла инвалидация, данные уже устарели
+            if generation == self.generation:
+                self.loaded_at = time.monotonic()
+
+    async def get(self, user_id):
+        """(username, role) администратора или None"""
+        if not self.is_fresh():
+            await self.refresh()
+        return self.admins.get(user_id)
+
+    async def find_username(self, username):
+        """(admin_id, username, role) по username без учета регистра или None"""
+        if not self.is_fresh():
+            await self.refresh()
+        return self.by_username.get(username.lower())
+
+role_cache = RoleCache(ROLE_CACHE_TTL)
+
+async def listen_admin_changes():
+    """Сбрасывать кэш ролей по NOTIFY admins_changed от любого процесса бота"""
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        try:
+            conn = await loop.run_in_executor(db_executor, get_connection)
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cursor:
+                cursor.execute("LISTEN admins_changed")
+            
+            lost = loop.create_future()
+            
+            def on_readable():
+                try:
+                    conn.poll()
+                except psycopg2.Error as e:
+                    if not lost.done():
+                        lost.set_result(e)
+                    return
+                if conn.notifies:
+                    conn.notifies.clear()
+                    role_cache.invalidate()
+            
+            loop.add_reader(conn.fileno(), on_readable)
+            # Пока не слушали, изменения могли пройти мимо
+            role_cache.invalidate()
+            try:
+                error = await lost
+            finally:
+                loop.remove_reader(conn.fileno())
+            logging.warning("LISTEN admins_changed прерван: %s", error)
+        except psycopg2.Error as e:
+            logging.warning("Не удалось подписаться на admins_changed: %s", e)
+        finally:
+            if conn is not None:
+                conn.close()
+        await asyncio.sleep(ROLE_LISTEN_RETRY)
+
+# 🪪 РОЛЬ ВЫЗВАВШЕГО
+# Роль автора Update ищется один раз в группе -2, раньше лимитов и команд, и
+# кладется в контекст: PTB передает один и тот же контекст всем группам Update
+class BotContext(CallbackContext):
+    """Контекст обработчиков с ролью вызвавшего"""
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id, user_id)
+        self.caller = None
+        self.caller_resolved = False
+
+async def resolve_caller(update: Update, context: BotContext):
+    """(username, role) автора Update из кэша ролей или None"""
+    db_caller.set(update.effective_user.id if update.effective_user else None)
+    if not update.effective_user or getattr(context, 'caller_resolved', False):
+        return
+    try:
+        context.caller = await role_cache.get(update.effective_user.id)
+        context.caller_resolved = True
+    except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+        # Не отвечаем ошибкой на каждое сообщение: команда повторит попытку сама
+        logging.warning("Не удалось определить роль %s: %s", update.effective_user.id, e)
+
+async def caller_role(update: Update, context: BotContext):
+    """'owner', 'admin' или 'user'; без повторного поиска, если роль уже в контексте"""
+    if not getattr(context, 'caller_resolved', False):
+        context.caller = await role_cache.get(update.effective_user.id)
+        context.caller_resolved = True
+    return context.caller[1] if context.caller else 'user'
+
+async def caller_is_admin(update: Update, context: BotContext):
+    return await caller_role(update, context) != 'user'
+
+async def caller_is_owner(update: Update, context: BotContext):
+    return await caller_role(update, context) == 'owner'
+
+async def is_target_owner(target_username):
+    admin = await role_cache.find_username(target_username)
+    return admin is not None and admin[2] == 'owner'
+
+async def find_admin(user_id=None, username=None):
+    """(admin_id, username, role) по id или username из кэша ролей"""
+    if user_id is not None:
+        admin = await role_cache.get(user_id)
+        return (user_id,) + admin if admin else None
+    return await role_cache.find_username(username)
+
+# 🧠 ИНДЕКС СКАМЕРОВ В ПАМЯТИ
+SCAMMER_INDEX_ENABLED = os.getenv('SCAMMER_INDEX_ENABLED', '0') == '1'
+SCAMMER_INDEX_REFRESH = float(os.getenv('SCAMMER_INDEX_REFRESH', '30'))
+SCAMMER_INDEX_MAX_STALENESS = float(os.getenv('SCAMMER_INDEX_MAX_STALENESS', '120'))
+SCAMMER_INDEX_RELOAD = float(os.getenv('SCAMMER_INDEX_RELOAD', '3600'))
+SCAMMER_INDEX_BATCH = 5000
+# id выдаются до коммита, поэтому строки могут появиться "позади" last_id;
+# каждый опрос перечитывает небольшое окно перед ним
+SCAMMER_INDEX_OVERLAP = 1000
+
+class ScammerIndex:
+    """Снимок таблицы scammers: user_id -> строка и lower(username) -> строка"""
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_username = {}
+        self.last_id = 0
+        self.synced_at = None
+        self.reloaded_at = None
+
+    def add(self, user_id, username, proof, scam_type):
+        row = (user_id, username, proof, scam_type)
+        self.by_id[user_id] = row
+        if username:
+            self.by_username[username.lower()] = row
+
+    def lookup(self, user_id=None, username=None):
+        if user_id is not None:
+            return self.by_id.get(user_id)
+        return self.by_username.get(username)
+
+    def is_fresh(self):
+        return self.synced_at is not None and time.monotonic() - self.synced_at < SCAMMER_INDEX_MAX_STALENESS
+
+    async def _load_since(self, last_id):
+        while True:
+            rows = await db_fetchall(
+                "SELECT id, user_id, username, proof, scam_type FROM scammers WHERE id > %s ORDER BY id LIMIT %s",
+                (last_id, SCAMMER_INDEX_BATCH)
+            )
+            for row_id, *row in rows:
+                self.add(*row)
+                last_id = row_id
+            if len(rows) < SCAMMER_INDEX_BATCH:
+                return last_id
+
+    async def reload(self):
+        """Полная перезагрузка: подхватывает удаления и правки строк"""
+        started = time.monotonic()
+        fresh = ScammerIndex()
+        fresh.last_id = await fresh._load_since(0)
+        self.by_id, self.by_username, self.last_id = fresh.by_id, fresh.by_username, fresh.last_id
+        self.synced_at = self.reloaded_at = started
+        print(f"🧠 Индекс скамеров загружен: {len(self.by_id)} записей")
+
+    async def refresh(self):
+        """Догрузить строки, добавленные после последнего опроса"""
+        started = time.monotonic()
+        last_id = await self._load_since(max(self.last_id - SCAMMER_INDEX_OVERLAP, 0))
+        self.last_id = max(self.last_id, last_id)
+        self.synced_at = started
+
+scammer_index = ScammerIndex() if SCAMMER_INDEX_ENABLED else None
+
+async def scammer_index_loop():
+    """Загрузить индекс при старте и обновлять его инкрементально"""
+    while True:
+        try:
+            if scammer_index.reloaded_at is None or time.monotonic() - scammer_index.reloaded_at > SCAMMER_INDEX_RELOAD:
+                await scammer_index.reload()
+            else:
+                await scammer_index.refresh()
+        except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+            logging.warning("Не удалось обновить индекс скамеров: %s", e)
+        await asyncio.sleep(SCAMMER_INDEX_REFRESH)
+
+# Поиск по id или по lower(username) — оба условия покрыты индексами
+CHECK_QUERY = '''
+    SELECT s.user_id, s.username, s.proof, s.scam_type, a.admin_id, a.username, a.role
+    FROM (SELECT 1) AS q
+    LEFT JOIN LATERAL (
+        SELECT user_id, username, proof, scam_type FROM scammers
+        WHERE user_id = %(user_id)s OR LOWER(username) = %(username)s
+        LIMIT 1
+    ) s ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT admin_id, username, role FROM admins
+        WHERE admin_id = %(user_id)s OR LOWER(username) = %(username)s
+        LIMIT 1
+    ) a ON TRUE
+'''
+
+# 🔎 НЕЧЕТКИЙ ПОИСК: /check ~name
+FUZZY_LIMIT = int(os.getenv('FUZZY_LIMIT', '5'))
+FUZZY_THRESHOLD = float(os.getenv('FUZZY_THRESHOLD', '0.3'))
+FUZZY_MIN_LENGTH = 3
+# Выставляется в _migrate по наличию расширения pg_trgm
+trgm_available = False
+
+# Сначала совпадения по префиксу, затем по убыванию триграммного сходства.
+# И оператор %, и LIKE 'abc%' обслуживает GIN-индекс scammers_username_trgm_idx
+FUZZY_QUERY = '''
+    SELECT user_id, username, proof, scam_type, similarity(LOWER(username), %(name)s) AS score
+    FROM scammers
+    WHERE LOWER(username) %% %(name)s OR LOWER(username) LIKE %(prefix)s
+    ORDER BY LOWER(username) LIKE %(prefix)s DESC, score DESC, user_id
+    LIMIT %(limit)s
+'''
+
+PREFIX_QUERY = '''
+    SELECT user_id, username, proof, scam_type, NULL AS score
+    FROM scammers
+    WHERE LOWER(username) LIKE %(prefix)s
+    ORDER BY LOWER(username)
+    LIMIT %(limit)s
+'''
+
+def escape_like(value):
+    """Экранировать спецсимволы LIKE: '_' встречается почти в каждом username"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _find_similar_scammers(cursor, name, limit):
+    params = {'name': name, 'prefix': escape_like(name) + '%', 'limit': limit}
+    if not trgm_available:
+        cursor.execute(PREFIX_QUERY, params)
+        return cursor.fetchall()
+    # Порог сходства действует только до конца транзакции
+    cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", (str(FUZZY_THRESHOLD),))
+    cursor.execute(FUZZY_QUERY, params)
+    return cursor.fetchall()
+
+def format_similar(name, rows):
+    if not rows:
+        return f"✅ Похожих username на «{name}» в базе скамеров не найдено."
+    text = f"🔎 Похожие на «{name}» в базе скамеров:\n\n"
+    for number, (user_id, username, proof, scam_type, score) in enumerate(rows, 1):
+        text += f"{number}. @{username} (ID: {user_id})"
+        if score is not None:
+            text += f" — {round(score * 100)}%"
+        text += f"\n   🎯 {scam_type or 'Не указан'}\n"
+    return text
+
+def format_scammer(scammer_data):
+    user_id, username, proof, scam_type = scammer_data
+    text = f"🚨 НАЙДЕН В БАЗЕ СКАМЕРОВ!\n\n👤 ID: `{user_id}`\n"
+    if username:
+        text += f"📱 Username: @{username}\n"
+    if scam_type:
+        text += f"🎯 Тип скама: {scam_type}\n"
+    text += f"📝 Пруфы: {proof}"
+    return text
+
+def format_admin(admin_data):
+    admin_id, username, role = admin_data
+    role_text = "👑 ВЛАДЕЛЕЦ" if role == 'owner' else "👮 АДМИНИСТРАТОР"
+    text = f"{role_text}\n\n👤 ID: `{admin_id}`\n"
+    if username:
+        text += f"📱 Username: @{username}\n"
+    text += f"💼 Роль: {role}"
+    return text
+
+async def get_counters(chat_id):
+    """Общие счетчики и счетчики чата: {(name, chat_id): value}"""
+    rows = await db_fetchall("SELECT name, chat_id, value FROM counters WHERE chat_id IN (0, %s)", (chat_id,), readonly=True)
+    return {(name, row_chat): value for name, row_chat, value in rows}
+
+# 📦 ИМПОРТ/ЭКСПОРТ СКАМЕРОВ
+IMPORT_FIELDS = ('user_id', 'username', 'proof', 'scam_type')
+# Файл держим в памяти до 1 МБ, дальше он уходит во временный файл на диске
+SPOOL_MAX_SIZE = 1024 * 1024
+
+def _iter_import_rows(raw_file, file_format):
+    """Строки файла в виде словарей; None — строка, которую не удалось разобрать"""
+    text = io.TextIOWrapper(raw_file, encoding='utf-8-sig', newline='')
+    if file_format == 'jsonl':
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+    else:
+        yield from csv.DictReader(text)
+
+def _normalize_import_row(row):
+    """(user_id, username, proof, scam_type) в формате scammers или None"""
+    if not row:
+        return None
+    user_id = str(row.get('user_id') or '').strip()
+    proof = str(row.get('proof') or '').strip()
+    if not user_id.isdigit() or not proof:
+        return None
+    username = str(row.get('username') or '').strip().lstrip('@').lower() or None
+    scam_type = str(row.get('scam_type') or '').strip() or "Не указан"
+    return int(user_id), username, proof, scam_type
+
+def _import_scammers(cursor, raw_file, file_format, added_by):
+    """COPY файла во временную таблицу и перенос новых записей в scammers"""
+    total = invalid = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+', newline='') as normalized:
+        writer = csv.writer(normalized)
+        for row in _iter_import_rows(raw_file, file_format):
+            total += 1
+            values = _normalize_import_row(row)
+            if values is None:
+                invalid += 1
+                continue
+            writer.writerow(values)
+        normalized.seek(0)
+        
+        cursor.execute('''
+            CREATE TEMP TABLE scammers_import (
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                proof TEXT NOT NULL,
+                scam_type TEXT
+            ) ON COMMIT DROP
+        ''')
+        cursor.copy_expert("COPY scammers_import (user_id, username, proof, scam_type) FROM STDIN WITH (FORMAT csv)", normalized)
+    
+    # Как и в /add_scammer, пропускаем совпадения по user_id и по username
+    cursor.execute('''
+        INSERT INTO scammers (user_id, username, proof, added_by, scam_type)
+        SELECT DISTINCT ON (i.user_id) i.user_id, i.username, i.proof, %s, i.scam_type
+        FROM scammers_import i
+        WHERE i.username IS NULL
+           OR NOT EXISTS (SELECT 1 FROM scammers s WHERE LOWER(s.username) = i.username)
+        ORDER BY i.user_id
+        ON CONFLICT (user_id) DO NOTHING
+    ''', (added_by,))
+    inserted = cursor.rowcount
+    return total, invalid, inserted
+
+def _export_scammers(cursor, out_file):
+    cursor.copy_expert(
+        "COPY (SELECT user_id, username, proof, scam_type FROM scammers ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)",
+        out_file
+    )
+
+def _insert_scammer(cursor, scammer_id, username, proof, added_by, scam_type):
+    cursor.execute("SELECT 1 FROM scammers WHERE user_id = %s OR LOWER(username) = %s", (scammer_id, username))
+    if cursor.fetchone():
+        return False
+    cursor.execute("INSERT INTO scammers (user_id, username, proof, added_by, scam_type) VALUES (%s, %s, %s, %s, %s)",
+                   (scammer_id, username, proof, added_by, scam_type))
+    return True
+
+def _insert_admin(cursor, admin_id, username, role):
+    cursor.execute("SELECT 1 FROM admins WHERE admin_id = %s OR LOWER(username) = LOWER(%s)", (admin_id, username))
+    if cursor.fetchone():
+        return False
+    cursor.execute("INSERT INTO admins (admin_id, username, role) VALUES (%s, %s, %s)",
+                   (admin_id, username, role))
+    return True
+
+WARN_LIMIT = 3
+
+async def add_warn(user_id, username, reason, warned_by, chat_id):
+    """Выдать варн; (число варнов в чате, сработал ли автобан)"""
+    return await db_fetchone(
+        "SELECT warn_count, banned FROM add_warn(%s, %s, %s, %s, %s, %s, %s)",
+        (user_id, username, reason, warned_by, chat_id, WARN_LIMIT,
+         f"Автобан за {WARN_LIMIT} варна (последний: {reason})"),
+        write=True
+    )
+
+# 📤 ОЧЕРЕДЬ ОТПРАВКИ
+# Все сообщения бота идут через очередь: у каждого чата своя очередь и свой темп,
+# плюс общий темп на весь бот. На 429 — пауза на retry_after и повтор.
+# Темп — "сообщений/секунд"
+SEND_GLOBAL_RATE = os.getenv('SEND_GLOBAL_RATE', '30/1')
+SEND_CHAT_RATE = os.getenv('SEND_CHAT_RATE', '20/60')
+# Если в очереди чата уже несколько текстов, ждем окно и отправляем их одним сообщением
+SEND_COALESCE_WINDOW = float(os.getenv('SEND_COALESCE_WINDOW', '0.25'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '10'))
+MESSAGE_TEXT_LIMIT = 4096
+
+def parse_rate(spec):
+    """'20/60' -> (20, 60.0)"""
+    count, _, period = spec.partition('/')
+    return int(count), float(period or 1)
+
+class SendPacer:
+    """Token bucket, который не отказывает, а говорит, сколько подождать"""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+def _consume_exception(future):
+    # Ошибку уже залогировал отправитель; без этого asyncio ругается на неполученное исключение
+    if not future.cancelled():
+        future.exception()
+
+class Outgoing:
+    """Сообщение в очереди и futures всех слитых в него сообщений"""
+
+    def __init__(self, bot, method, kwargs):
+        self.bot = bot
+        self.method = method
+        self.kwargs = kwargs
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self.futures = [future]
+
+    def can_merge(self, other):
+        if self.method != 'send_message' or other.method != 'send_message' or self.bot is not other.bot:
+            return False
+        if 'reply_markup' in self.kwargs or 'reply_markup' in other.kwargs:
+            return False
+        # Сливаем только сообщения с одинаковыми параметрами: ответ на ту же команду, та же разметка
+        mine = {key: value for key, value in self.kwargs.items() if key != 'text'}
+        theirs = {key: value for key, value in other.kwargs.items() if key != 'text'}
+        return mine == theirs and len(self.kwargs['text']) + len(other.kwargs['text']) + 2 <= MESSAGE_TEXT_LIMIT
+
+    def merge(self, other):
+        self.kwargs['text'] += '\n\n' + other.kwargs['text']
+        self.futures += other.futures
+
+class OutboundSender:
+    """Очереди сообщений по чатам; бот берется из каждого сообщения, поэтому подходит и заглушка"""
+
+    def __init__(self):
+        self.queues = {}
+        self.workers = {}
+        self.global_pacer = SendPacer(*parse_rate(SEND_GLOBAL_RATE))
+        self.chat_rate = parse_rate(SEND_CHAT_RATE)
+        self.chat_pacers = {}
+
+    def send(self, bot, chat_id, method='send_message', **kwargs):
+        """Поставить сообщение в очередь чата; вернуть future с отправленным Message"""
+        item = Outgoing(bot, method, kwargs)
+        self.queues.setdefault(chat_id, deque()).append(item)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+        return item.futures[0]
+
+    async def drain(self, timeout=None):
+        """Дождаться отправки всего, что уже стоит в очередях"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.workers:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(list(self.workers.values()), timeout=remaining)
+        return True
+
+    async def _run_chat(self, chat_id):
+        queue = self.queues[chat_id]
+        pacer = self.chat_pacers.get(chat_id)
+        if pacer is None:
+            pacer = self.chat_pacers[chat_id] = SendPacer(*self.chat_rate)
+        try:
+            while queue:
+                item = queue.popleft()
+                if item.method == 'send_message' and SEND_COALESCE_WINDOW and queue:
+                    # В чате уже очередь: ждем хвост пачки, одиночный ответ уходит сразу
+                    await asyncio.sleep(SEND_COALESCE_WINDOW)
+                await asyncio.sleep(max(pacer.reserve(), self.global_pacer.reserve()))
+                while queue and item.can_merge(queue[0]):
+                    item.merge(queue.popleft())
+                await self._deliver(chat_id, item)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                del self.queues[chat_id]
+            asyncio.get_running_loop().call_later(pacer.period, self._forget_pacer, chat_id)
+
+    def _forget_pacer(self, chat_id):
+        # За период корзина восстановилась и ничем не отличается от новой
+        pacer = self.chat_pacers.get(chat_id)
+        if pacer and chat_id not in self.workers and time.monotonic() - pacer.updated >= pacer.period:
+            del self.chat_pacers[chat_id]
+
+    async def _deliver(self, chat_id, item):
+        method = getattr(item.bot, item.method)
+        error = None
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            # Файл при повторе читается заново
+            for value in item.kwargs.values():
+                if hasattr(value, 'seek'):
+                    value.seek(0)
+            try:
+                result = await method(chat_id=chat_id, **item.kwargs)
+            except RetryAfter as e:
+                error = e
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                metrics.inc('bot_send_retries_total', (('reason', 'flood'),))
+                logging.warning("429 в чате %s, повтор через %s с", chat_id, delay)
+                await asyncio.sleep(delay)
+                continue
+            except TimedOut as e:
+                # Сообщение могло уже уйти: повтор дал бы дубль
+                error = e
+                break
+            except (BadRequest, Forbidden) as e:
+                # Наследники NetworkError, но повтор их не исправит
+                error = e
+                break
+            except NetworkError as e:
+                error = e
+                metrics.inc('bot_send_retries_total', (('reason', 'network'),))
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            except Exception as e:
+                error = e
+                break
+            metrics.inc('bot_messages_sent_total')
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(result)
+            return
+        
+        metrics.inc('bot_send_failures_total')
+        logging.warning("Не удалось отправить %s в %s: %s", item.method, chat_id, error)
+        for future in item.futures:
+            if not future.done():
+                future.set_exception(error)
+
+outbound = OutboundSender()
+
+async def reply(update: Update, text=None, method='send_message', wait=False, **kwargs):
+    """Ответ на сообщение через очередь отправки.
+    
+    В группах — ответом на исходное сообщение, как reply_text. wait=True — дождаться
+    отправки и вернуть Message (или получить ошибку отправки).
+    """
+    message = update.effective_message
+    if text is not None:
+        kwargs['text'] = text
+    if update.effective_chat.type != 'private':
+        kwargs.setdefault('reply_to_message_id', message.message_id)
+        kwargs.setdefault('allow_sending_without_reply', True)
+    future = outbound.send(message.get_bot(), message.chat_id, method, **kwargs)
+    return await future if wait else None
+
+# 📇 СПРАВОЧНИК ПОЛЬЗОВАТЕЛЕЙ
+# Каждое сообщение в чате обновляет users и chat_members, но не сразу: изменения
+# копятся в памяти и пишутся пачкой раз в USER_FLUSH_INTERVAL секунд
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '5'))
+USER_FLUSH_MAX = int(os.getenv('USER_FLUSH_MAX', '5000'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+# Группа обработчиков после всех команд
+USER_TRACKING_GROUP = 10
+
+def _upsert_users(cursor, users, seen):
+    # Строки отсортированы по ключу, чтобы параллельные пачки не ловили deadlock
+    if users:
+        execute_values(cursor, '''
+            INSERT INTO users (user_id, username) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, last_seen = CURRENT_TIMESTAMP
+        ''', sorted(users.items()), page_size=len(users))
+    if seen:
+        execute_values(cursor, '''
+            INSERT INTO chat_members (chat_id, user_id) VALUES %s
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+        ''', sorted(seen), page_size=len(seen))
+
+class UserDirectory:
+    """Буфер записи в users/chat_members и LRU lower(username) -> user_id"""
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = OrderedDict()
+        self.pending_users = {}
+        self.pending_seen = set()
+        self.flush_now = asyncio.Event()
+
+    def _cache(self, username, user_id):
+        key = username.lower()
+        self.ids[key] = user_id
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+
+    def remember(self, chat_id, user):
+        """Горячий путь: только словари в памяти, без обращения к БД"""
+        if user.username:
+            self._cache(user.username, user.id)
+        self.pending_users[user.id] = user.username
+        self.pending_seen.add((chat_id, user.id))
+        if len(self.pending_users) + len(self.pending_seen) >= USER_FLUSH_MAX:
+            self.flush_now.set()
+
+    async def resolve(self, usernames):
+        """{lower(username): user_id} для известных справочнику пользователей"""
+        found, missing = {}, []
+        for username in usernames:
+            key = username.lower()
+            if key in self.ids:
+                self.ids.move_to_end(key)
+                found[key] = self.ids[key]
+            else:
+                missing.append(key)
+        if missing:
+            # Username мог перейти к другому пользователю — берем того, кто виделся последним
+            rows = await db_fetchall('''
+                SELECT DISTINCT ON (LOWER(username)) LOWER(username), user_id FROM users
+                WHERE LOWER(username) = ANY(%s)
+                ORDER BY LOWER(username), last_seen DESC
+            ''', (missing,))
+            for key, user_id in rows:
+                self._cache(key, user_id)
+                found[key] = user_id
+        return found
+
+    async def flush(self):
+        """Записать буфер; при ошибке вернуть его обратно, не затирая более свежие данные"""
+        users, seen = self.pending_users, self.pending_seen
+        if not users and not seen:
+            return True
+        self.pending_users, self.pending_seen = {}, set()
+        try:
+            await db_run(_upsert_users, users, seen, write=True)
+            return True
+        except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+            logging.warning("Не удалось записать справочник пользователей: %s", e)
+            for user_id, username in users.items():
+                self.pending_users.setdefault(user_id, username)
+            self.pending_seen |= seen
+            return False
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            if not await self.flush():
+                await asyncio.sleep(USER_FLUSH_INTERVAL)
+
+user_directory = UserDirectory(USER_CACHE_SIZE)
+
+# 👥 ПАКЕТНАЯ МОДЕРАЦИЯ
+BATCH_MAX_TARGETS = int(os.getenv('BATCH_MAX_TARGETS', '50'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '5'))
+# Число считается ID цели, только если похоже на Telegram ID, иначе это начало причины
+MIN_USER_ID_DIGITS = 5
+
+def parse_targets(update: Update, args):
+    """Цели из ответа на сообщение и из начала аргументов; остальное — причина.
+    
+    Цель — (user_id или 0, username или None). Повторы отбрасываются.
+    ID в списке целей пишется как id:123456789; голое число считается ID, только
+    если это единственная возможная цель — первый аргумент команды не ответом.
+    Иначе "/ban @spammer 100500 рублей" забанил бы пользователя 100500.
+    """
+    targets = []
+    reply = update.message.reply_to_message
+    if reply and reply.from_user and not reply.from_user.is_bot:
+        targets.append((reply.from_user.id, reply.from_user.username))
+    
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        user_id = arg[3:] if arg.lower().startswith('id:') else None
+        if arg.startswith('@') and len(arg) > 1:
+            targets.append((0, arg[1:]))
+        elif user_id and user_id.isdigit():
+            targets.append((int(user_id), None))
+        elif i == 0 and not targets and arg.isdigit() and len(arg) >= MIN_USER_ID_DIGITS:
+            targets.append((int(arg), None))
+        else:
+            break
+        i += 1
+    
+    unique, seen = [], set()
+    for target_id, username in targets:
+        key = username.lower() if username else target_id
+        if key not in seen:
+            seen.add(key)
+            unique.append((target_id, username))
+    return unique, ' '.join(args[i:])
+
+async def resolve_targets(targets):
+    """Подставить user_id из справочника туда, где известен только username"""
+    usernames = [username for target_id, username in targets if not target_id and username]
+    if not usernames:
+        return targets
+    try:
+        ids = await user_directory.resolve(usernames)
+    except DB_OUTAGE_ERRORS:
+        # Без базы банится по username только в записи, в Telegram — цели с ID
+        return targets
+    return [
+        (target_id or (ids.get(username.lower(), 0) if username else 0), username)
+        for target_id, username in targets
+    ]
+
+def target_label(target):
+    target_id, username = target
+    return f"@{username}" if username else f"ID {target_id}"
+
+async def split_owners(targets):
+    """(цели без владельцев, владельцы) — все цели проверяются по кэшу ролей"""
+    allowed, owners = [], []
+    for target in targets:
+        target_id, username = target
+        admin = await find_admin(user_id=target_id) if target_id else None
+        if not admin and username:
+            admin = await find_admin(username=username)
+        (owners if admin and admin[2] == 'owner' else allowed).append(target)
+    return allowed, owners
+
+async def run_bounded(calls, limit=BATCH_CONCURRENCY):
+    """Выполнить вызовы параллельно, не больше limit одновременно.
+    
+    calls — функции без аргументов, возвращающие корутину; исключения
+    попадают в список результатов, а не пробрасываются.
+    """
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(call):
+        async with semaphore:
+            return await call()
+    
+    return await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
+
+def _insert_bans(cursor, rows):
+    execute_values(cursor, "INSERT INTO bans (user_id, username, reason, banned_by, chat_id) VALUES %s",
+                   rows, page_size=len(rows))
+
+def _add_warns(cursor, rows):
+    # Все варны одним запросом; строки отсортированы по username, чтобы параллельные
+    # пачки брали advisory lock в add_warn в одном порядке и не ловили deadlock
+    return execute_values(cursor, '''
+        SELECT t.username, w.warn_count, w.banned
+        FROM (VALUES %s) AS t(user_id, username, reason, warned_by, chat_id, warn_limit, ban_reason)
+        CROSS JOIN LATERAL add_warn(t.user_id, t.username, t.reason, t.warned_by, t.chat_id, t.warn_limit, t.ban_reason) w
+    ''', sorted(rows, key=lambda row: row[1].lower()),
+        template="(%s::bigint, %s, %s, %s::bigint, %s::bigint, %s, %s)", page_size=len(rows), fetch=True)
+
+async def ban_in_telegram(bot, chat_id, user_ids):
+    """Забанить пользователей с известным ID; вернуть число ошибок"""
+    results = await run_bounded([functools.partial(bot.ban_chat_member, chat_id, uid) for uid in user_ids])
+    for uid, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logging.warning("Не удалось забанить %s в %s: %s", uid, chat_id, result)
+    return sum(isinstance(result, Exception) for result in results)
+
+# 🔇 МУТЫ
+DURATION_UNITS = {
+    's': 1, 'с': 1,
+    'm': 60, 'м': 60,
+    'h': 3600, 'ч': 3600,
+    'd': 86400, 'д': 86400,
+    'w': 604800, 'н': 604800,
+}
+# Дольше 366 дней Telegram считает ограничение бессрочным
+MUTE_MAX_SECONDS = 366 * 86400
+MUTE_BATCH_SIZE = int(os.getenv('MUTE_BATCH_SIZE', '500'))
+# Сроки, наступающие в пределах окна, снимаются одной пачкой
+MUTE_BATCH_WINDOW = float(os.getenv('MUTE_BATCH_WINDOW', '1'))
+MUTE_RETRY_DELAY = 10
+
+def parse_duration(text):
+    """'30m', '1h', '2д' -> секунды или None"""
+    match = re.fullmatch(r'(\d+)\s*([a-zа-я])', text.strip().lower())
+    if not match or match.group(2) not in DURATION_UNITS:
+        return None
+    seconds = int(match.group(1)) * DURATION_UNITS[match.group(2)]
+    return seconds if 0 < seconds <= MUTE_MAX_SECONDS else None
+
+async def add_mute(user_id, username, reason, muted_by, chat_id, seconds):
+    """Записать мут со сроком и поставить его в планировщик"""
+    row = await db_fetchone(
+        "INSERT INTO mutes (user_id, username, reason, muted_by, chat_id, unmute_date) "
+        "VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s)) RETURNING id",
+        (user_id, username, reason, muted_by, chat_id, seconds),
+        write=True
+    )
+    mute_scheduler.schedule(row[0], seconds)
+    return row[0]
+
+class MuteScheduler:
+    """Снятие мутов по unmute_date: min-heap сроков и одна спящая задача.
+    
+    Сроки хранятся во времени цикла событий (loop.time()), поэтому часовой пояс
+    сервера БД не важен. Снятие — DELETE ... RETURNING: мут, снятый вручную или
+    другим процессом, не будет снят второй раз.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, mute_id, delay):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        if not self.heap or deadline < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (deadline, mute_id))
+
+    async def load(self):
+        """Загрузить все муты со сроком, в том числе уже истекшие за время простоя"""
+        last_id = 0
+        while True:
+            rows = await db_fetchall(
+                "SELECT id, EXTRACT(EPOCH FROM unmute_date - CURRENT_TIMESTAMP) FROM mutes "
+                "WHERE unmute_date IS NOT NULL AND id > %s ORDER BY id LIMIT %s",
+                (last_id, MUTE_BATCH_SIZE)
+            )
+            for mute_id, remaining in rows:
+                self.schedule(mute_id, max(float(remaining), 0))
+                last_id = mute_id
+            if len(rows) < MUTE_BATCH_SIZE:
+                break
+        print(f"🔇 Планировщик мутов: {len(self.heap)} активных мутов")
+
+    async def _sleep_until_due(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            timeout = self.heap[0][0] - loop.time() if self.heap else None
+            if timeout is not None and timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self, application: Application):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.load()
+                break
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+                logging.warning("Не удалось загрузить муты: %s", e)
+                await asyncio.sleep(MUTE_RETRY_DELAY)
+        
+        while True:
+            await self._sleep_until_due()
+            horizon = loop.time() + MUTE_BATCH_WINDOW
+            due = []
+            while self.heap and self.heap[0][0] <= horizon and len(due) < MUTE_BATCH_SIZE:
+                due.append(heapq.heappop(self.heap)[1])
+            
+            try:
+                lifted = await db_fetchall(
+                    "DELETE FROM mutes WHERE id = ANY(%s) RETURNING user_id, username, chat_id", (due,), write=True
+                )
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+                logging.warning("Не удалось снять муты, повтор через %s с: %s", MUTE_RETRY_DELAY, e)
+                for mute_id in due:
+                    heapq.heappush(self.heap, (loop.time() + MUTE_RETRY_DELAY, mute_id))
+                continue
+            
+            await self._announce(application, lifted)
+
+    async def _announce(self, application: Application, lifted):
+        by_chat = {}
+        for user_id, username, chat_id in lifted:
+            by_chat.setdefault(chat_id, []).append((user_id, username))
+        
+        for chat_id, users in by_chat.items():
+            for user_id, _ in users:
+                if user_id:
+                    try:
+                        await application.bot.restrict_chat_member(chat_id, user_id, ChatPermissions.all_permissions())
+                    except Exception as e:
+                        logging.warning("Не удалось снять ограничения с %s в %s: %s", user_id, chat_id, e)
+            names = ', '.join(f"@{username}" if username else str(user_id) for user_id, username in users)
+            outbound.send(application.bot, chat_id, text=f"🔊 Срок мута истек: {names}")
+
+mute_scheduler = MuteScheduler()
+
+# 🛟 РЕЖИМ БЕЗ БАЗЫ
+# Пока Postgres недоступен, /check отвечает по локальному снимку scammers и admins
+# (SQLite, обновляется раз в SNAPSHOT_INTERVAL), а баны, варны, муты и новые скамеры
+# дописываются в журнал JSONL. После восстановления журнал применяется по порядку;
+# id каждой записи попадает в journal_applied в той же транзакции, что и сама запись,
+# поэтому повторное применение (сбой посреди воспроизведения) ничего не задвоит.
+DEGRADED_MODE = os.getenv('DEGRADED_MODE', '1') == '1'
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'snapshot.sqlite3')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '300'))
+SNAPSHOT_BATCH = 5000
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', 'journal.jsonl')
+JOURNAL_REPLAY_INTERVAL = float(os.getenv('JOURNAL_REPLAY_INTERVAL', '10'))
+# Записи журнала, чьи файлы уже удалены, больше не встретятся
+JOURNAL_APPLIED_RETENTION_DAYS = 7
+
+class LocalSnapshot:
+    """Снимок scammers и admins в SQLite; пишется во временный файл и подменяет старый целиком"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write_snapshot(self, cursor):
+        """Выполняется в потоке БД: читает Postgres пачками и пишет SQLite"""
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        local = sqlite3.connect(tmp_path)
+        try:
+            local.execute("CREATE TABLE scammers (user_id INTEGER PRIMARY KEY, username TEXT, proof TEXT, scam_type TEXT)")
+            local.execute("CREATE TABLE admins (admin_id INTEGER PRIMARY KEY, username TEXT, role TEXT)")
+            local.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+            last_id = 0
+            while True:
+                cursor.execute(
+                    "SELECT id, user_id, username, proof, scam_type FROM scammers WHERE id > %s ORDER BY id LIMIT %s",
+                    (last_id, SNAPSHOT_BATCH)
+                )
+                rows = cursor.fetchall()
+                local.executemany("INSERT OR REPLACE INTO scammers VALUES (?, ?, ?, ?)", [row[1:] for row in rows])
+                if len(rows) < SNAPSHOT_BATCH:
+                    break
+                last_id = rows[-1][0]
+            cursor.execute("SELECT admin_id, username, role FROM admins")
+            local.executemany("INSERT INTO admins VALUES (?, ?, ?)", cursor.fetchall())
+            local.execute("CREATE INDEX scammers_username_idx ON scammers (lower(username))")
+            local.execute("CREATE INDEX admins_username_idx ON admins (lower(username))")
+            local.execute("INSERT INTO meta VALUES ('taken_at', ?)", (time.time(),))
+            local.commit()
+        finally:
+            local.close()
+        os.replace(tmp_path, self.path)
+
+    def _connect(self):
+        # Только чтение: отсутствующий файл — ошибка, а не новая пустая база
+        return sqlite3.connect(f"file:{urlparse.quote(os.path.abspath(self.path))}?mode=ro", uri=True)
+
+    def _check(self, user_id, username):
+        local = self._connect()
+        try:
+            scammer = local.execute(
+                "SELECT user_id, username, proof, scam_type FROM scammers WHERE user_id = ? OR lower(username) = ? LIMIT 1",
+                (user_id, username)
+            ).fetchone()
+            admin = local.execute(
+                "SELECT admin_id, username, role FROM admins WHERE admin_id = ? OR lower(username) = ? LIMIT 1",
+                (user_id, username)
+            ).fetchone()
+            taken_at = local.execute("SELECT value FROM meta WHERE key = 'taken_at'").fetchone()[0]
+        finally:
+            local.close()
+        return (scammer or (None,) * 4) + (admin or (None,) * 3), taken_at
+
+    def _admins(self):
+        local = self._connect()
+        try:
+            return local.execute("SELECT admin_id, username, role FROM admins").fetchall()
+        finally:
+            local.close()
+
+    async def check(self, user_id=None, username=None):
+        """(строка как у CHECK_QUERY, время снимка) или None, если снимка нет"""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._check, user_id, username)
+        except sqlite3.Error as e:
+            logging.warning("Снимок базы недоступен: %s", e)
+            return None
+
+    async def admins(self):
+        """Строки admins из снимка или None"""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._admins)
+        except sqlite3.Error as e:
+            logging.warning("Снимок базы недоступен: %s", e)
+            return None
+
+async def snapshot_loop():
+    """Обновление снимка, пока база доступна"""
+    await db_ready.wait()
+    while True:
+        if db_available.is_set():
+            try:
+                await db_run(local_snapshot.write_snapshot, readonly=True)
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable, sqlite3.Error, OSError) as e:
+                logging.warning("Не удалось обновить снимок базы: %s", e)
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+def _insert_mute(cursor, user_id, username, reason, muted_by, chat_id, seconds, muted_at):
+    """Мут из журнала: сроки считаются от времени команды, а не применения; (id, секунд до снятия)"""
+    cursor.execute(
+        "INSERT INTO mutes (user_id, username, reason, muted_by, chat_id, mute_date, unmute_date) "
+        "VALUES (%s, %s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s) + make_interval(secs => %s)) "
+        "RETURNING id, EXTRACT(EPOCH FROM unmute_date - CURRENT_TIMESTAMP)",
+        (user_id, username, reason, muted_by, chat_id, muted_at, muted_at, seconds)
+    )
+    return cursor.fetchone()
+
+# Операция журнала -> функция, которая выполняет ее с курсором
+JOURNAL_OPS = {
+    'ban': _insert_bans,
+    'warn': _add_warns,
+    'mute': _insert_mute,
+    'add_scammer': _insert_scammer,
+}
+
+def _apply_journal_entry(cursor, op_id, op, args):
+    """(результат, True) или (None, False), если запись уже применялась"""
+    cursor.execute("INSERT INTO journal_applied (op_id, op) VALUES (%s, %s) ON CONFLICT (op_id) DO NOTHING", (op_id, op))
+    if not cursor.rowcount:
+        return None, False
+    return JOURNAL_OPS[op](cursor, *args), True
+
+def _trim_journal_applied(cursor):
+    cursor.execute(
+        "DELETE FROM journal_applied WHERE applied_at < CURRENT_TIMESTAMP - make_interval(days => %s)",
+        (JOURNAL_APPLIED_RETENTION_DAYS,)
+    )
+
+class WriteJournal:
+    """Журнал записей, отложенных до восстановления базы.
+    
+    Пишем в JOURNAL_PATH; перед воспроизведением файл переименовывается в .replay,
+    и новые записи идут уже в свежий файл. Строки, которые база отвергла, уходят
+    в .rejected для ручного разбора. Вся работа с файлами — в одном отдельном
+    потоке: fsync не блокирует цикл событий, а запись и переименование не
+    перемешиваются.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.replay_path = path + '.replay'
+        self.rejected_path = path + '.rejected'
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def append(self, op, *args):
+        entry = {'id': uuid.uuid4().hex, 'op': op, 'at': time.time(), 'args': args}
+        await self._in_thread(self._write_line, self.path, json.dumps(entry, ensure_ascii=False))
+        print(f"📝 База недоступна, {op} записан в журнал")
+
+    def _write_line(self, path, line):
+        # fsync: запись, о которой уже ответили в чат, не должна пропасть при падении
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def has_pending(self):
+        return os.path.exists(self.replay_path) or os.path.exists(self.path)
+
+    def _take_lines(self):
+        if not os.path.exists(self.replay_path):
+            os.replace(self.path, self.replay_path)
+        with open(self.replay_path, encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    async def replay(self, bot):
+        """Применить все записи по порядку; вернуть число примененных"""
+        lines = await self._in_thread(self._take_lines)
+        
+        applied = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                result, fresh = await db_run(_apply_journal_entry, entry['id'], entry['op'], entry['args'], write=True)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, DatabaseBusy, DatabaseUnavailable):
+                # База снова пропала: файл остается, следующая попытка пропустит примененное
+                raise
+            except (psycopg2.Error, ValueError, KeyError, TypeError) as e:
+                logging.error("Запись журнала отвергнута: %s (%s)", line, e)
+                await self._in_thread(self._write_line, self.rejected_path, line)
+                continue
+            if fresh:
+                applied += 1
+                await self._after_apply(bot, entry, result)
+        
+        await self._in_thread(os.remove, self.replay_path)
+        await db_run(_trim_journal_applied, write=True)
+        return applied
+
+    async def _after_apply(self, bot, entry, result):
+        """Что в обычном пути делает обработчик после записи в БД"""
+        op, args = entry['op'], entry['args']
+        if op == 'warn':
+            # Автобан, который сработал только сейчас, доводим до Telegram
+            banned = {username.lower() for username, _, banned in result if banned}
+            by_chat = {}
+            for target_id, username, _, _, chat_id, _, _ in args[0]:
+                if target_id and username.lower() in banned:
+                    by_chat.setdefault(chat_id, []).append(target_id)
+            for chat_id, user_ids in by_chat.items():
+                await ban_in_telegram(bot, chat_id, user_ids)
+        elif op == 'mute':
+            mute_id, remaining = result
+            mute_scheduler.schedule(mute_id, max(float(remaining), 0))
+        elif op == 'add_scammer' and result and scammer_index:
+            scammer_id, username, proof, _, scam_type = args
+            scammer_index.add(scammer_id, username, proof, scam_type)
+
+local_snapshot = LocalSnapshot(SNAPSHOT_PATH) if DEGRADED_MODE else None
+write_journal = WriteJournal(JOURNAL_PATH) if DEGRADED_MODE else None
+
+async def journal_write(error, op, *args):
+    """Отложить запись до восстановления базы.
+    
+    False — журнал выключен или соединение оборвалось на COMMIT: запись могла
+    уже дойти до базы, и повтор из журнала ее бы задвоил.
+    """
+    if write_journal is None or isinstance(error, CommitUnknown):
+        return False
+    await write_journal.append(op, *args)
+    return True
+
+JOURNAL_NOTE = "\n\n📝 База данных недоступна: запись сохранена в журнал и попадет в базу после восстановления."
+
+async def journal_replay_loop(application: Application):
+    """Применение журнала, как только база снова доступна"""
+    await db_ready.wait()
+    while True:
+        if write_journal.has_pending() and db_available.is_set():
+            try:
+                applied = await write_journal.replay(application.bot)
+                if applied:
+                    print(f"📝 Из журнала применено записей: {applied}")
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable, OSError) as e:
+                logging.warning("Журнал не применен, повтор через %s с: %s", JOURNAL_REPLAY_INTERVAL, e)
+        await asyncio.sleep(JOURNAL_REPLAY_INTERVAL)
+
+# 🚪 ПРОВЕРКА НОВЫХ УЧАСТНИКОВ
+# off — выключена, alert — сообщить админам чата, ban — сразу забанить
+SCREENING_MODES = ('off', 'alert', 'ban')
+# Входы в чат копятся окно времени и проверяются одним запросом: рейд из сотни
+# аккаунтов дает один запрос к БД и одно сообщение в чат
+SCREENING_WINDOW = float(os.getenv('SCREENING_WINDOW', '3'))
+SCREENING_BATCH_MAX = 500
+SCREENING_MODE_TTL = 300
+SCREENING_ALERT_MAX = 30
+
+screening_modes = {}
+
+async def get_screening_mode(chat_id):
+    """Режим проверки чата; кэшируется на SCREENING_MODE_TTL секунд"""
+    cached = screening_modes.get(chat_id)
+    if cached and time.monotonic() - cached[1] < SCREENING_MODE_TTL:
+        return cached[0]
+    row = await db_fetchone("SELECT screening FROM chats WHERE chat_id = %s", (chat_id,))
+    mode = row[0] if row else 'off'
+    screening_modes[chat_id] = (mode, time.monotonic())
+    return mode
+
+async def set_screening_mode(chat_id, title, mode):
+    await db_execute(
+        "INSERT INTO chats (chat_id, title, screening) VALUES (%s, %s, %s) "
+        "ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, screening = EXCLUDED.screening",
+        (chat_id, title, mode)
+    )
+    screening_modes[chat_id] = (mode, time.monotonic())
+
+class JoinScreener:
+    """Окно сбора входов по чату: первый вход запускает таймер, по нему пачка проверяется"""
+
+    def __init__(self):
+        self.pending = {}
+        self.timers = {}
+        self.running = set()
+
+    def add(self, bot, chat_id, mode, users):
+        batch = self.pending.setdefault(chat_id, {})
+        for user in users:
+            batch[user.id] = user.username
+        if len(batch) >= SCREENING_BATCH_MAX:
+            timer = self.timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            self._start(self.screen(bot, chat_id, mode, self.pending.pop(chat_id)))
+        elif chat_id not in self.timers:
+            self.timers[chat_id] = self._start(self._screen_later(bot, chat_id, mode))
+
+    def _start(self, coro):
+        task = asyncio.create_task(coro)
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+        return task
+
+    async def _screen_later(self, bot, chat_id, mode):
+        await asyncio.sleep(SCREENING_WINDOW)
+        self.timers.pop(chat_id, None)
+        batch = self.pending.pop(chat_id, None)
+        if batch:
+            await self.screen(bot, chat_id, mode, batch)
+
+    async def _find_scammers(self, user_ids):
+        if scammer_index and scammer_index.is_fresh():
+            rows = (scammer_index.lookup(user_id=user_id) for user_id in user_ids)
+            return [(row[0], row[1], row[3]) for row in rows if row]
+        return await db_fetchall(
+            "SELECT user_id, username, scam_type FROM scammers WHERE user_id = ANY(%s)", (user_ids,), readonly=True
+        )
+
+    async def screen(self, bot, chat_id, mode, batch):
+        """Одна пачка: один запрос к базе и одно сообщение в чат"""
+        try:
+            found = await self._find_scammers(list(batch))
+            if not found:
+                return
+            failed = 0
+            if mode == 'ban':
+                await db_run(_insert_bans, [
+                    (user_id, username, f"Скамер из базы: {scam_type or 'тип не указан'}", bot.id, chat_id)
+                    for user_id, username, scam_type in found
+                ], write=True)
+                failed = await ban_in_telegram(bot, chat_id, [user_id for user_id, _, _ in found])
+            outbound.send(bot, chat_id, text=format_screening_alert(found, mode, failed))
+        except Exception as e:
+            logging.warning("Не удалось проверить новых участников %s: %s", chat_id, e)
+
+def format_screening_alert(found, mode, failed):
+    text = f"🚨 В чат вошли скамеры из базы: {len(found)}\n\n"
+    for user_id, username, scam_type in found[:SCREENING_ALERT_MAX]:
+        text += f"• {'@' + username if username else 'ID ' + str(user_id)} ({user_id}) — {scam_type or 'тип не указан'}\n"
+    if len(found) > SCREENING_ALERT_MAX:
+        text += f"…и еще {len(found) - SCREENING_ALERT_MAX}\n"
+    if mode == 'ban':
+        text += "\n🔨 Забанены автоматически."
+        if failed:
+            text += f"\n⚠️ Не удалось забанить в Telegram: {failed}"
+    else:
+        text += "\n👮 Администраторы, проверьте этих участников! Подробности: /check ID"
+    return text
+
+join_screener = JoinScreener()
 
-def ensure_connection():
-    """Проверить и восстановить соединение с БД"""
-    global conn, cursor
+# 🌐 ГЛОБАЛЬНЫЙ БАН
+# /gban банит во всех чатах, где бот админ с правом банить. Чаты берутся из chats
+# (статус бота приходит в my_chat_member), на каждый чат — строка в global_ban_chats.
+# Результаты пишутся пачками по GBAN_CHUNK чатов: после перезапуска рассылка
+# продолжается с оставшихся pending, уже обработанные чаты не повторяются.
+GBAN_CONCURRENCY = int(os.getenv('GBAN_CONCURRENCY', '5'))
+# Темп вызовов banChatMember, отдельно от темпа сообщений
+GBAN_RATE = os.getenv('GBAN_RATE', '10/1')
+GBAN_CHUNK = int(os.getenv('GBAN_CHUNK', '50'))
+GBAN_PROGRESS_INTERVAL = float(os.getenv('GBAN_PROGRESS_INTERVAL', '5'))
+GBAN_RETRY_DELAY = 10
+# Ошибки, после которых банить в чате бессмысленно, пока бота не вернут в админы
+GBAN_CHAT_GONE = ('forbidden', 'not enough rights', 'chat not found')
+
+# Чаты, статус бота в которых уже известен этому процессу
+known_chats = set()
+
+async def set_bot_status(chat_id, title, member):
+    """Запомнить статус бота в чате по ChatMember"""
+    can_ban = member.status == ChatMember.ADMINISTRATOR and bool(member.can_restrict_members)
+    await db_execute(
+        "INSERT INTO chats (chat_id, title, bot_status, can_ban, status_updated) "
+        "VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP) "
+        "ON CONFLICT (chat_id) DO UPDATE SET title = COALESCE(EXCLUDED.title, chats.title), "
+        "bot_status = EXCLUDED.bot_status, can_ban = EXCLUDED.can_ban, status_updated = EXCLUDED.status_updated",
+        (chat_id, title, member.status, can_ban)
+    )
+    known_chats.add(chat_id)
+
+async def discover_chat(bot, chat):
+    """Чат, куда бота добавили до появления my_chat_member: статус спрашиваем один раз"""
     try:
-        cursor.execute("SELECT 1")
-    except:
-        print("🔁 Восстанавливаем соединение с БД...")
-        conn = get_connection()
-        cursor = conn.cursor()
+        row = await db_fetchone("SELECT bot_status FROM chats WHERE chat_id = %s", (chat.id,))
+        if not row or not row[0]:
+            await set_bot_status(chat.id, chat.title, await bot.get_chat_member(chat.id, bot.id))
+    except Exception as e:
+        logging.warning("Не удалось узнать статус бота в %s: %s", chat.id, e)
+        known_chats.discard(chat.id)
 
-def is_owner(user_id):
-    ensure_connection()
-    cursor.execute("SELECT 1 FROM admins WHERE admin_id = %s AND role = 'owner'", (user_id,))
-    return cursor.fetchone() is not None
+def is_chat_gone(error):
+    error = error.lower()
+    return any(marker in error for marker in GBAN_CHAT_GONE)
 
-def is_admin(user_id):
-    ensure_connection()
-    cursor.execute("SELECT 1 FROM admins WHERE admin_id = %s", (user_id,))
-    return cursor.fetchone() is not None
+def _create_global_ban(cursor, user_id, username, reason, banned_by, chat_id):
+    """Глобальный бан и по строке pending на каждый чат; вернуть (id, число чатов)"""
+    cursor.execute(
+        "INSERT INTO global_bans (user_id, username, reason, banned_by, chat_id) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+        (user_id, username, reason, banned_by, chat_id)
+    )
+    ban_id = cursor.fetchone()[0]
+    cursor.execute(
+        "INSERT INTO global_ban_chats (ban_id, chat_id) SELECT %s, chat_id FROM chats WHERE can_ban",
+        (ban_id,)
+    )
+    return ban_id, cursor.rowcount
 
-def get_user_role(user_id):
-    ensure_connection()
-    cursor.execute("SELECT role FROM admins WHERE admin_id = %s", (user_id,))
-    result = cursor.fetchone()
-    return result[0] if result else 'user'
+def _checkpoint_global_ban(cursor, ban_id, ban, results):
+    """Записать итоги пачки чатов; вернуть счетчики {status: count}.
+    
+    Обновляются только строки, еще стоящие в pending: если ту же пачку параллельно
+    прошел другой процесс, баны в bans не задвоятся.
+    """
+    user_id, username, reason, banned_by = ban[:4]
+    updated = execute_values(cursor, '''
+        UPDATE global_ban_chats AS g SET status = r.status, error = r.error
+        FROM (VALUES %s) AS r(ban_id, chat_id, status, error)
+        WHERE g.ban_id = r.ban_id AND g.chat_id = r.chat_id AND g.status = 'pending'
+        RETURNING g.chat_id, g.status
+    ''', [(ban_id,) + result for result in results],
+        template="(%s::integer, %s::bigint, %s, %s)", page_size=len(results), fetch=True)
+    done = [chat_id for chat_id, status in updated if status == 'done']
+    if done:
+        _insert_bans(cursor, [(user_id, username, reason, banned_by, chat_id) for chat_id in done])
+    # Бота выгнали или лишили прав — чат выпадает из следующих рассылок
+    gone = [chat_id for chat_id, status, error in results if status == 'failed' and is_chat_gone(error)]
+    if gone:
+        cursor.execute("UPDATE chats SET can_ban = FALSE, status_updated = CURRENT_TIMESTAMP WHERE chat_id = ANY(%s)", (gone,))
+    return _global_ban_counts(cursor, ban_id)
 
-def is_target_owner(target_username):
-    ensure_connection()
-    cursor.execute("SELECT 1 FROM admins WHERE username = %s AND role = 'owner'", (target_username,))
-    return cursor.fetchone() is not None
+def _global_ban_counts(cursor, ban_id):
+    cursor.execute("SELECT status, COUNT(*) FROM global_ban_chats WHERE ban_id = %s GROUP BY status", (ban_id,))
+    counts = dict(cursor.fetchall())
+    if not counts.get('pending'):
+        cursor.execute("UPDATE global_bans SET finished_at = CURRENT_TIMESTAMP WHERE id = %s AND finished_at IS NULL", (ban_id,))
+    return counts
+
+def format_global_ban(ban, counts):
+    user_id, username, reason = ban[:3]
+    total = sum(counts.values())
+    pending = counts.get('pending', 0)
+    title = "🌐 Глобальный бан" if pending else "🌐 Глобальный бан завершен"
+    text = f"{title}: {target_label((user_id, username))} ({user_id})\nПричина: {reason}\n\n"
+    text += f"✅ Забанен в чатах: {counts.get('done', 0)} из {total}\n"
+    if counts.get('failed'):
+        text += f"⚠️ Не удалось: {counts['failed']}\n"
+    if pending:
+        text += f"⏳ Осталось: {pending}\n"
+    return text
+
+class GlobalBanRunner:
+    """Рассылка глобальных банов: не больше GBAN_CONCURRENCY чатов одновременно"""
+
+    def __init__(self):
+        self.running = {}
+        self.pacer = None
+
+    def start(self, bot, ban_id):
+        if ban_id in self.running:
+            return
+        task = start_background(self._run(bot, ban_id))
+        self.running[ban_id] = task
+        task.add_done_callback(lambda _: self.running.pop(ban_id, None))
+
+    async def resume(self, application: Application):
+        """Продолжить рассылки, прерванные остановкой бота"""
+        while True:
+            try:
+                rows = await db_fetchall("SELECT id FROM global_bans WHERE finished_at IS NULL ORDER BY id")
+                break
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+                logging.warning("Не удалось загрузить глобальные баны: %s", e)
+                await asyncio.sleep(GBAN_RETRY_DELAY)
+        for (ban_id,) in rows:
+            print(f"🌐 Продолжаем глобальный бан #{ban_id}")
+            self.start(application.bot, ban_id)
+
+    async def _run(self, bot, ban_id):
+        while True:
+            try:
+                await self._fan_out(bot, ban_id)
+                return
+            except (psycopg2.Error, DatabaseBusy, DatabaseUnavailable) as e:
+                # Сделанное уже в чекпоинте, повтор начнет с оставшихся чатов
+                logging.warning("Глобальный бан #%s прерван, повтор через %s с: %s", ban_id, GBAN_RETRY_DELAY, e)
+                await asyncio.sleep(GBAN_RETRY_DELAY)
+
+    async def _fan_out(self, bot, ban_id):
+        ban = await db_fetchone(
+            "SELECT user_id, username, reason, banned_by, chat_id, progress_message_id FROM global_bans WHERE id = %s",
+            (ban_id,)
+        )
+        if not ban:
+            return
+        user_id, chat_id, message_id = ban[0], ban[4], ban[5]
+        if self.pacer is None:
+            self.pacer = SendPacer(*parse_rate(GBAN_RATE))
+        shown = None
+        last_shown = time.monotonic()
+        while True:
+            pending = await db_fetchall(
+                "SELECT chat_id FROM global_ban_chats WHERE ban_id = %s AND status = 'pending' ORDER BY chat_id LIMIT %s",
+                (ban_id, GBAN_CHUNK)
+            )
+            if not pending:
+                counts = await db_run(_global_ban_counts, ban_id, write=True)
+                break
+            chats = [row[0] for row in pending]
+            results = await run_bounded(
+                [functools.partial(self._ban_in_chat, bot, target_chat, user_id) for target_chat in chats],
+                GBAN_CONCURRENCY
+            )
+            results = [
+                (target_chat, 'failed', f"{type(result).__name__}: {result}") if isinstance(result, Exception) else result
+                for target_chat, result in zip(chats, results)
+            ]
+            counts = await db_run(_checkpoint_global_ban, ban_id, ban, results, write=True)
+            if message_id and time.monotonic() - last_shown >= GBAN_PROGRESS_INTERVAL:
+                shown = self._show(bot, chat_id, message_id, format_global_ban(ban, counts), shown)
+                last_shown = time.monotonic()
+        
+        text = format_global_ban(ban, counts)
+        if message_id:
+            self._show(bot, chat_id, message_id, text, shown)
+        elif chat_id:
+            outbound.send(bot, chat_id, text=text)
+        print(f"🌐 Глобальный бан #{ban_id}: {counts}")
+
+    def _show(self, bot, chat_id, message_id, text, shown):
+        # Telegram отвечает ошибкой на правку без изменений
+        if text != shown:
+            outbound.send(bot, chat_id, method='edit_message_text', message_id=message_id, text=text)
+        return text
+
+    async def _ban_in_chat(self, bot, chat_id, user_id):
+        """(chat_id, 'done'|'failed', ошибка); бан идемпотентен, поэтому таймауты повторяем"""
+        error = None
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await asyncio.sleep(self.pacer.reserve())
+            try:
+                await bot.ban_chat_member(chat_id, user_id)
+                return chat_id, 'done', None
+            except RetryAfter as e:
+                error = e
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                await asyncio.sleep(delay)
+            except (Forbidden, BadRequest) as e:
+                error = e
+                break
+            except NetworkError as e:
+                error = e
+                await asyncio.sleep(min(2 ** attempt, 30))
+        logging.warning("Глобальный бан %s в %s: %s", user_id, chat_id, error)
+        return chat_id, 'failed', f"{type(error).__name__}: {error}"
+
+global_bans = GlobalBanRunner()
+
+# 🖼️ КАРТОЧКИ СТАТУСА
+STATUS_CARDS_ENABLED = os.getenv('STATUS_CARDS_ENABLED', '0') == '1'
+STATUS_FONT_PATH = os.getenv('STATUS_FONT_PATH', '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf')
+STATUS_CARD_CACHE_SIZE = int(os.getenv('STATUS_CARD_CACHE_SIZE', '256'))
+# Подпись к фото в Telegram ограничена 1024 символами
+PHOTO_CAPTION_LIMIT = 1024
+
+render_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='render')
+status_fonts = None
+# file_id уже загруженных карточек: повторно отправляем по id, без загрузки байтов
+status_card_file_ids = OrderedDict()
+
+def load_status_fonts():
+    """Загрузить шрифты карточек один раз при запуске"""
+    global status_fonts
+    try:
+        # Pillow нужен только карточкам, поэтому импортируется здесь, а не при старте
+        from PIL import ImageFont
+        status_fonts = (ImageFont.truetype(STATUS_FONT_PATH, 48), ImageFont.truetype(STATUS_FONT_PATH, 22))
+    except (ImportError, OSError) as e:
+        # Встроенный растровый шрифт не умеет кириллицу, без TTF карточки не рисуем
+        status_fonts = None
+        logging.warning("Шрифт %s не загружен, карточки статуса отключены: %s", STATUS_FONT_PATH, e)
 
 def create_status_image(status, user_info=""):
+    from PIL import Image, ImageDraw
+    
     colors = {
         'скамер': ('#FF0000', '#FFFFFF'),
         'владелец': ('#FFD700', '#000000'),
@@ -156,21 +2430,22 @@ def create_status_image(status, user_info=""):
     draw.rectangle([0, 0, width-1, height-1], outline='#000000', width=5)
     
     # Шрифт
-    font = ImageFont.load_default()
+    title_font, info_font = status_fonts
     
     # Основной текст
     status_text = status.upper()
-    text_width = len(status_text) * 20
-    text_height = 30
+    left, top, right, bottom = draw.textbbox((0, 0), status_text, font=title_font)
+    text_width = right - left
+    text_height = bottom - top
     
     x = (width - text_width) // 2
     y = (height - text_height) // 2
     
-    draw.text((x, y), status_text, fill=text_color, font=font)
+    draw.text((x, y), status_text, fill=text_color, font=title_font)
     
     # Дополнительная информация
     if user_info:
-        draw.text((50, y + 50), user_info, fill=text_color, font=font)
+        draw.text((50, y + text_height + 30), user_info, fill=text_color, font=info_font)
     
     img_byte_arr = io.BytesIO()
     image.save(img_byte_arr, format='PNG')
@@ -178,10 +2453,134 @@ def create_status_image(status, user_info=""):
     
     return img_byte_arr
 
+@functools.lru_cache(maxsize=STATUS_CARD_CACHE_SIZE)
+def render_status_card(status, user_info=""):
+    """PNG карточки в байтах; одинаковые карточки рисуются один раз"""
+    return create_status_image(status, user_info).getvalue()
+
+async def reply_status(update: Update, status, user_info, text):
+    """Ответ на /check: карточка статуса с подписью или просто текст"""
+    if not STATUS_CARDS_ENABLED or status_fonts is None:
+        await reply(update, text, parse_mode='Markdown')
+        return
+    
+    key = (status, user_info)
+    caption = text if len(text) <= PHOTO_CAPTION_LIMIT else None
+    photo = status_card_file_ids.get(key)
+    if photo:
+        status_card_file_ids.move_to_end(key)
+    else:
+        # Pillow рисует и кодирует PNG в отдельном потоке, не блокируя цикл событий
+        loop = asyncio.get_running_loop()
+        photo = await loop.run_in_executor(render_executor, render_status_card, status, user_info)
+    
+    sent = await reply(update, method='send_photo', photo=photo, caption=caption, parse_mode='Markdown', wait=True)
+    if key not in status_card_file_ids and sent and sent.photo:
+        status_card_file_ids[key] = sent.photo[-1].file_id
+        if len(status_card_file_ids) > STATUS_CARD_CACHE_SIZE:
+            status_card_file_ids.popitem(last=False)
+    
+    if caption is None:
+        await reply(update, text, parse_mode='Markdown')
+
+# 🚦 ОГРАНИЧЕНИЕ ЧАСТОТЫ КОМАНД
+# Формат: "команда=запросов/секунд,...", "*" — лимит для остальных команд
+USER_RATE_LIMITS = os.getenv('USER_RATE_LIMITS', 'check=5/60,stats=2/60,*=10/60')
+CHAT_RATE_LIMITS = os.getenv('CHAT_RATE_LIMITS', 'check=30/60,stats=6/60,*=60/60')
+
+def parse_rate_limits(spec):
+    """'check=5/60,*=10/60' -> {'check': (5, 60.0), '*': (10, 60.0)}"""
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        command, _, value = item.partition('=')
+        capacity, _, period = value.partition('/')
+        limits[command.strip().lower()] = (int(capacity), float(period))
+    return limits
+
+class RateLimiter:
+    """Token bucket на каждую пару (команда, ключ) с вытеснением простаивающих корзин"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.max_period = max((period for _, period in limits.values()), default=0)
+        # (команда, ключ) -> [токены, время обновления, уже предупредили]
+        self.buckets = OrderedDict()
+
+    def allow(self, command, key):
+        limit = self.limits.get(command) or self.limits.get('*')
+        if not limit:
+            return True
+        capacity, period = limit
+        now = time.monotonic()
+        bucket = self.buckets.pop((command, key), None)
+        if bucket is None:
+            bucket = [capacity, now, False]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+        
+        allowed = bucket[0] >= 1
+        if allowed:
+            bucket[0] -= 1
+            bucket[2] = False
+        # Порядок словаря — порядок последнего обращения
+        self.buckets[(command, key)] = bucket
+        self._evict(now)
+        return allowed
+
+    def should_notify(self, command, key):
+        """Предупредить о лимите один раз за серию отброшенных запросов"""
+        bucket = self.buckets.get((command, key))
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+    def _evict(self, now):
+        # Корзина, простоявшая дольше периода, снова полна и ничем не отличается от новой
+        while self.buckets:
+            tokens, updated, _ = next(iter(self.buckets.values()))
+            if now - updated < self.max_period:
+                break
+            self.buckets.popitem(last=False)
+
+user_limiter = RateLimiter(parse_rate_limits(USER_RATE_LIMITS))
+chat_limiter = RateLimiter(parse_rate_limits(CHAT_RATE_LIMITS))
+bot_commands = set()
+
+async def rate_limit_guard(update: Update, context: CallbackContext):
+    """Отбрасывает команды сверх лимита до того, как они дойдут до БД"""
+    message = update.effective_message
+    if not message or not message.text or not message.text.startswith('/'):
+        return
+    if update.effective_chat.type == 'private' or not update.effective_user:
+        return
+    
+    command, _, mention = message.text.split()[0][1:].partition('@')
+    command = command.lower()
+    if command not in bot_commands or (mention and mention.lower() != (context.bot.username or '').lower()):
+        return
+    
+    user_id = update.effective_user.id
+    if not user_limiter.allow(command, user_id):
+        if user_limiter.should_notify(command, user_id):
+            await reply(update, "⏳ Слишком много запросов, подождите немного.")
+        raise ApplicationHandlerStop
+    
+    chat_id = update.effective_chat.id
+    if not chat_limiter.allow(command, chat_id):
+        if chat_limiter.should_notify(command, chat_id):
+            await reply(update, "⏳ Слишком много запросов в этом чате, подождите немного.")
+        raise ApplicationHandlerStop
+
 def only_in_chats(func):
+    @functools.wraps(func)
     async def wrapper(update: Update, context: CallbackContext):
         if update.effective_chat.type == 'private':
-            await update.message.reply_text(
+            await reply(
+                update,
                 "❌ Этот бот работает только в чатах и группах!\n\n"
                 "Добавьте бота в ваш чат и используйте команды там."
             )
@@ -191,17 +2590,16 @@ def only_in_chats(func):
 
 @only_in_chats
 async def start(update: Update, context: CallbackContext):
-    ensure_connection()
     user_id = update.effective_user.id
     username = update.effective_user.username
     full_name = update.effective_user.full_name
     chat_title = update.effective_chat.title
     
-    if is_admin(user_id) and username:
-        cursor.execute("UPDATE admins SET username = %s WHERE admin_id = %s", (username, user_id))
-        conn.commit()
+    role = await caller_role(update, context)
+    if context.caller and username and context.caller[0] != username:
+        await db_execute("UPDATE admins SET username = %s WHERE admin_id = %s", (username, user_id))
+        role_cache.invalidate()
     
-    role = get_user_role(user_id)
     role_text = "👑 Владелец" if role == 'owner' else "👮 Администратор" if role == 'admin' else "👤 Пользователь"
     
     text = (
@@ -210,180 +2608,170 @@ async def start(update: Update, context: CallbackContext):
         "📝 Основные команды:\n"
         "• /check @username - Проверить пользователя\n"
         "• /check 123456789 - Проверить по ID\n"
+        "• /check ~username - Найти похожие username скамеров\n"
         "• /stats - Статистика базы\n"
         "• /help - Справка по командам\n"
     )
     
-    if is_admin(user_id):
+    if role != 'user':
         text += "\n👮 Команды модерации:\n"
         text += "• /ban @username причина - Забанить пользователя\n"
+        text += "• /gban @username причина - Забанить во всех чатах бота\n"
         text += "• /unban @username - Разбанить пользователя\n"
         text += "• /warn @username причина - Выдать варн\n"
         text += "• /mute @username время причина - Замутить\n"
         text += "• /unmute @username - Размутить\n"
         text += "• /warns @username - Посмотреть варны\n"
         text += "• /banlist - Список банов\n"
+        text += "• /screening off|alert|ban - Проверка новых участников\n"
         text += "• /add_scammer user_id @username|пруфы|тип - Добавить скамера\n"
     
-    if is_owner(user_id):
+    if role == 'owner':
         text += "\n👑 Команды владельца:\n"
         text += "• /add_admin user_id @username - Добавить администратора\n"
         text += "• /add_owner user_id @username - Добавить владельца\n"
         text += "• /list_admins - Список администраторов\n"
+        text += "• /import_scammers - Импорт скамеров из CSV/JSONL\n"
+        text += "• /export_scammers - Выгрузка базы скамеров\n"
     
-    await update.message.reply_text(text)
+    await reply(update, text)
 
 @only_in_chats
 async def help_command(update: Update, context: CallbackContext):
-    ensure_connection()
-    user_id = update.effective_user.id
-    
     text = (
         "📖 Справка по командам базы скамеров:\n\n"
         "👤 Основные команды:\n"
         "• /start - Запустить бота\n"
         "• /check @username - Проверить пользователя\n"
         "• /check 123456789 - Проверить по ID\n"
+        "• /check ~username - Найти похожие username скамеров\n"
         "• /stats - Статистика базы\n"
         "• /help - Эта справка\n\n"
     )
     
-    if is_admin(user_id):
+    if await caller_is_admin(update, context):
         text += (
             "👮 Команды модерации:\n"
             "• /ban @username причина - Бан пользователя\n"
+            "• /gban @username причина - Бан во всех чатах бота\n"
             "• /unban @username - Разбан пользователя\n"
             "• /warn @username причина - Выдать варн\n"
             "• /mute @username время причина - Мут\n"
             "• /unmute @username - Размутить\n"
             "• /warns @username - Варны пользователя\n"
             "• /banlist - Список банов\n"
+            "• /screening off|alert|ban - Проверка новых участников\n"
             "• /add_scammer user_id @username|пруфы|тип - Добавить скамера\n\n"
             "⚠️ Невозможно выдать санкции владельцу!\n\n"
             "Примеры:\n"
             "/ban @username Спам\n"
+            "/ban @user1 @user2 @user3 Рейд\n"
             "/warn @username Оскорбления\n"
             "/mute @username 1h Флуд\n"
             "/mute @username 30m Реклама\n"
         )
     
-    if is_owner(user_id):
+    if await caller_is_owner(update, context):
         text += (
             "👑 Команды владельца:\n"
             "• /add_admin user_id @username - Добавить администратора\n"
             "• /add_owner user_id @username - Добавить владельца\n"
             "• /list_admins - Список администраторов\n"
+            "• /import_scammers - Импорт скамеров из CSV/JSONL (ответом на файл)\n"
+            "• /export_scammers - Выгрузка базы скамеров в CSV\n"
         )
     
-    await update.message.reply_text(text)
+    await reply(update, text)
 
 @only_in_chats
 async def check_user(update: Update, context: CallbackContext):
-    ensure_connection()
     if not context.args:
-        await update.message.reply_text("❌ Использование: /check @username или /check 123456789")
+        await reply(update, "❌ Использование: /check @username, /check 123456789 или /check ~username")
         return
     
     search_query = context.args[0].strip()
     print(f"🔍 Поиск: {search_query}")
 
-    # Проверяем базу скамеров
-    if search_query.isdigit():
-        cursor.execute("SELECT user_id, username, proof, scam_type FROM scammers WHERE user_id = %s", (int(search_query),))
-        scammer_data = cursor.fetchone()
-        
-        if scammer_data:
-            user_id, username, proof, scam_type = scammer_data
-            text = f"🚨 НАЙДЕН В БАЗЕ СКАМЕРОВ!\n\n👤 ID: `{user_id}`\n"
-            if username:
-                text += f"📱 Username: @{username}\n"
-            if scam_type:
-                text += f"🎯 Тип скама: {scam_type}\n"
-            text += f"📝 Пруфы: {proof}"
-            await update.message.reply_text(text, parse_mode='Markdown')
-            return
-
-    elif search_query.startswith('@'):
-        username = search_query[1:].lower()
-        cursor.execute("SELECT user_id, username, proof, scam_type FROM scammers WHERE LOWER(username) = %s", (username,))
-        scammer_data = cursor.fetchone()
-        
-        if scammer_data:
-            user_id, username, proof, scam_type = scammer_data
-            text = f"🚨 НАЙДЕН В БАЗЕ СКАМЕРОВ!\n\n👤 ID: `{user_id}`\n📱 Username: @{username}\n"
-            if scam_type:
-                text += f"🎯 Тип скама: {scam_type}\n"
-            text += f"📝 Пруфы: {proof}"
-            await update.message.reply_text(text, parse_mode='Markdown')
+    if search_query.startswith('~'):
+        name = search_query[1:].lstrip('@').lower()
+        if len(name) < FUZZY_MIN_LENGTH:
+            await reply(update, f"❌ Для поиска похожих нужно хотя бы {FUZZY_MIN_LENGTH} символа: /check ~username")
             return
+        rows = await db_run(_find_similar_scammers, name, FUZZY_LIMIT, readonly=True)
+        # Без Markdown: подчеркивания в username ломают разметку
+        await reply(update, format_similar(name, rows))
+        return
 
-    # Проверяем админов
     if search_query.isdigit():
-        cursor.execute("SELECT admin_id, username, role FROM admins WHERE admin_id = %s", (int(search_query),))
-        admin_data = cursor.fetchone()
-        
-        if admin_data:
-            admin_id, username, role = admin_data
-            role_text = "👑 ВЛАДЕЛЕЦ" if role == 'owner' else "👮 АДМИНИСТРАТОР"
-            text = f"{role_text}\n\n👤 ID: `{admin_id}`\n"
-            if username:
-                text += f"📱 Username: @{username}\n"
-            text += f"💼 Роль: {role}"
-            await update.message.reply_text(text, parse_mode='Markdown')
-            return
-
+        target = {'user_id': int(search_query), 'username': None}
     elif search_query.startswith('@'):
-        username = search_query[1:].lower()
-        cursor.execute("SELECT admin_id, username, role FROM admins WHERE LOWER(username) = %s", (username,))
-        admin_data = cursor.fetchone()
-        
-        if admin_data:
-            admin_id, username, role = admin_data
-            role_text = "👑 ВЛАДЕЛЕЦ" if role == 'owner' else "👮 АДМИНИСТРАТОР"
-            text = f"{role_text}\n\n👤 ID: `{admin_id}`\n📱 Username: @{username}\n💼 Роль: {role}"
-            await update.message.reply_text(text, parse_mode='Markdown')
-            return
-
-    # Если не найден нигде
-    text = "✅ ОБЫЧНЫЙ ПОЛЬЗОВАТЕЛЬ\n\nНе найден в базе скамеров и не является администратором."
-    await update.message.reply_text(text, parse_mode='Markdown')
+        target = {'user_id': None, 'username': search_query[1:].lower()}
+    else:
+        target = None
+    
+    scammer_data = admin_data = None
+    note = ""
+    if target and scammer_index and scammer_index.is_fresh():
+        # Свежий снимок в памяти: промах в нем означает, что скамера нет
+        scammer_data = scammer_index.lookup(**target)
+        if not scammer_data:
+            admin_data = await find_admin(**target)
+    
+    elif target:
+        # Скамер и админ проверяются одним запросом
+        try:
+            row = await db_fetchone(CHECK_QUERY, target, readonly=True)
+        except DB_OUTAGE_ERRORS:
+            snapshot = await local_snapshot.check(**target) if local_snapshot else None
+            if snapshot is None:
+                raise
+            row, taken_at = snapshot
+            note = f"\n\n⚠️ База данных недоступна, ответ по снимку от {datetime.fromtimestamp(taken_at):%d.%m.%Y %H:%M}"
+        if row[0] is not None:
+            scammer_data = row[:4]
+        elif row[4] is not None:
+            admin_data = row[4:]
+    
+    if scammer_data:
+        await reply_status(update, 'скамер', f"ID: {scammer_data[0]}", format_scammer(scammer_data) + note)
+    elif admin_data:
+        status = 'владелец' if admin_data[2] == 'owner' else 'администратор'
+        await reply_status(update, status, f"ID: {admin_data[0]}", format_admin(admin_data) + note)
+    else:
+        # Если не найден нигде
+        text = "✅ ОБЫЧНЫЙ ПОЛЬЗОВАТЕЛЬ\n\nНе найден в базе скамеров и не является администратором."
+        await reply_status(update, 'обычный пользователь', "", text + note)
 
 @only_in_chats
 async def stats(update: Update, context: CallbackContext):
-    ensure_connection()
-    cursor.execute("SELECT COUNT(*) FROM scammers")
-    scammer_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM admins")
-    admin_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM bans")
-    ban_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM warns")
-    warn_count = cursor.fetchone()[0]
+    chat_id = update.effective_chat.id
+    counters = await get_counters(chat_id)
     
     text = (
         f"📊 СТАТИСТИКА БАЗЫ ДАННЫХ:\n\n"
-        f"🚨 Скамеров в базе: {scammer_count}\n"
-        f"👮 Администраторов: {admin_count}\n"
-        f"🔨 Активных банов: {ban_count}\n"
-        f"⚠️ Всего варнов: {warn_count}"
+        f"🚨 Скамеров в базе: {counters.get(('scammers', 0), 0)}\n"
+        f"👮 Администраторов: {counters.get(('admins', 0), 0)}\n"
+        f"🔨 Активных банов: {counters.get(('bans', 0), 0)}\n"
+        f"⚠️ Всего варнов: {counters.get(('warns', 0), 0)}\n\n"
+        f"💬 В этом чате:\n"
+        f"🔨 Банов: {counters.get(('bans', chat_id), 0)}\n"
+        f"⚠️ Варнов: {counters.get(('warns', chat_id), 0)}\n"
+        f"🔇 Мутов: {counters.get(('mutes', chat_id), 0)}"
     )
     
-    await update.message.reply_text(text)
+    await reply(update, text)
 
 @only_in_chats
 async def add_scammer(update: Update, context: CallbackContext):
-    ensure_connection()
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ Только администраторы могут добавлять скамеров!")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут добавлять скамеров!")
         return
     
     if not context.args:
-        await update.message.reply_text(
+        await reply(
+            update,
             "❌ Использование: /add_scammer user_id @username|пруфы|тип\n\n"
             "Примеры:\n"
             "/add_scammer 123456789 @scammer|Кинул на 1000р|Невывод\n"
@@ -396,183 +2784,261 @@ async def add_scammer(update: Update, context: CallbackContext):
     try:
         parts = data.split('|')
         if len(parts) < 2:
-            await update.message.reply_text("❌ Неверный формат. Нужно: user_id @username|пруфы|тип")
+            await reply(update, "❌ Неверный формат. Нужно: user_id @username|пруфы|тип")
             return
         
         first_part = parts[0].strip().split()
         if len(first_part) < 2:
-            await update.message.reply_text("❌ Укажите ID и username! Формат: user_id @username")
+            await reply(update, "❌ Укажите ID и username! Формат: user_id @username")
             return
         
         user_id_part = first_part[0]
         username_part = first_part[1]
         
         if not user_id_part.isdigit():
-            await update.message.reply_text("❌ User ID должен быть числом!")
+            await reply(update, "❌ User ID должен быть числом!")
             return
         
         scammer_id = int(user_id_part)
         
         if not username_part.startswith('@'):
-            await update.message.reply_text("❌ Username должен начинаться с @!")
+            await reply(update, "❌ Username должен начинаться с @!")
             return
         
         username = username_part[1:].lower()
         proof = parts[1].strip()
         scam_type = parts[2].strip() if len(parts) > 2 else "Не указан"
         
-        cursor.execute("SELECT 1 FROM scammers WHERE user_id = %s OR username = %s", (scammer_id, username))
-        if cursor.fetchone():
-            await update.message.reply_text("❌ Этот пользователь уже есть в базе скамеров!")
-            return
-        
-        cursor.execute("INSERT INTO scammers (user_id, username, proof, added_by, scam_type) VALUES (%s, %s, %s, %s, %s)",
-                      (scammer_id, username, proof, user_id, scam_type))
-        conn.commit()
+        try:
+            if not await db_run(_insert_scammer, scammer_id, username, proof, user_id, scam_type, write=True):
+                await reply(update, "❌ Этот пользователь уже есть в базе скамеров!")
+                return
+            note = ""
+        except DB_OUTAGE_ERRORS as e:
+            # Дубликат отбросит _insert_scammer при применении журнала
+            if not await journal_write(e, 'add_scammer', scammer_id, username, proof, user_id, scam_type):
+                raise
+            note = JOURNAL_NOTE
+        if scammer_index:
+            scammer_index.add(scammer_id, username, proof, scam_type)
         
-        await update.message.reply_text(f"✅ Скамер добавлен!\n👤 ID: {scammer_id}\n📱 Username: @{username}\n🎯 Тип: {scam_type}")
+        await reply(update, f"✅ Скамер добавлен!\n👤 ID: {scammer_id}\n📱 Username: @{username}\n🎯 Тип: {scam_type}" + note)
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при добавлении: {str(e)}")
+        await reply(update, f"❌ Ошибка при добавлении: {str(e)}")
 
 @only_in_chats
 async def ban_user(update: Update, context: CallbackContext):
-    ensure_connection()
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ Только администраторы могут банить пользователей!")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут банить пользователей!")
         return
     
-    if not context.args or len(context.args) < 2:
-        await update.message.reply_text("❌ Использование: /ban @username причина")
-        return
-    
-    target_username = context.args[0]
-    reason = ' '.join(context.args[1:])
+    targets, reason = parse_targets(update, context.args or [])
     
-    if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Укажите username пользователя (начинается с @)")
+    if not targets or not reason:
+        await reply(
+            update,
+            "❌ Использование: /ban @username причина\n"
+            "Несколько целей: /ban @user1 @user2 id:123456789 причина\n"
+            "Или ответом на сообщение: /ban причина"
+        )
         return
     
-    target_username = target_username[1:]
+    if len(targets) > BATCH_MAX_TARGETS:
+        await reply(update, f"❌ Не больше {BATCH_MAX_TARGETS} пользователей за раз!")
+        return
     
-    if is_target_owner(target_username):
-        await update.message.reply_text("❌ Невозможно забанить владельца!")
+    targets, owners = await split_owners(await resolve_targets(targets))
+    if not targets:
+        await reply(update, "❌ Невозможно забанить владельца!")
         return
     
     try:
-        cursor.execute("INSERT INTO bans (user_id, username, reason, banned_by, chat_id) VALUES (%s, %s, %s, %s, %s)",
-                      (0, target_username, reason, user_id, chat_id))
-        conn.commit()
+        rows = [(target_id, username, reason, user_id, chat_id) for target_id, username in targets]
+        try:
+            await db_run(_insert_bans, rows, write=True)
+            note = ""
+        except DB_OUTAGE_ERRORS as e:
+            if not await journal_write(e, 'ban', rows):
+                raise
+            note = JOURNAL_NOTE
+        failed = await ban_in_telegram(context.bot, chat_id, [target_id for target_id, _ in targets if target_id])
+        
+        if len(targets) == 1 and not owners and not failed:
+            await reply(update, f"✅ Пользователь {target_label(targets[0])} забанен!\nПричина: {reason}" + note)
+            return
         
-        await update.message.reply_text(f"✅ Пользователь @{target_username} забанен!\nПричина: {reason}")
+        text = f"✅ Забанено: {len(targets)}\nПричина: {reason}\n\n"
+        text += "\n".join(f"• {target_label(target)}" for target in targets)
+        if owners:
+            text += "\n\n👑 Пропущены владельцы: " + ", ".join(target_label(target) for target in owners)
+        if failed:
+            text += f"\n\n⚠️ Не удалось забанить в Telegram: {failed}"
+        await reply(update, text + note)
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при бане: {str(e)}")
+        await reply(update, f"❌ Ошибка при бане: {str(e)}")
 
 @only_in_chats
 async def unban_user(update: Update, context: CallbackContext):
-    ensure_connection()
-    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ Только администраторы могут разбанивать пользователей!")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут разбанивать пользователей!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Использование: /unban @username")
+        await reply(update, "❌ Использование: /unban @username")
         return
     
     target_username = context.args[0]
     
     if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Укажите username пользователя (начинается с @)")
+        await reply(update, "❌ Укажите username пользователя (начинается с @)")
         return
     
     target_username = target_username[1:]
     
     try:
-        cursor.execute("DELETE FROM bans WHERE username = %s", (target_username,))
-        conn.commit()
+        rows = await db_fetchall(
+            "DELETE FROM bans WHERE chat_id = %s AND LOWER(username) = LOWER(%s) RETURNING user_id",
+            (chat_id, target_username),
+            write=True
+        )
+        # ID — из записи бана, а если там 0 (бан по username) — из справочника
+        target_id = next((row[0] for row in rows if row[0]), 0)
+        if not target_id:
+            [(target_id, _)] = await resolve_targets([(0, target_username)])
         
-        if cursor.rowcount > 0:
-            await update.message.reply_text(f"✅ Пользователь @{target_username} разбанен!")
+        # unban_chat_member отвечает True и для не забаненных, поэтому статус смотрим заранее
+        banned_in_chat = False
+        if target_id:
+            try:
+                member = await context.bot.get_chat_member(chat_id, target_id)
+                banned_in_chat = member.status == ChatMember.BANNED
+                if banned_in_chat:
+                    await context.bot.unban_chat_member(chat_id, target_id, only_if_banned=True)
+            except Exception as e:
+                logging.warning("Не удалось разбанить %s в %s: %s", target_id, chat_id, e)
+                await reply(
+                    update,
+                    f"⚠️ @{target_username}: " + ("запись о бане удалена, но " if rows else "")
+                    + "снять бан в Telegram не удалось"
+                )
+                return
+        
+        if rows:
+            text = f"✅ Пользователь @{target_username} разбанен!"
+            if not target_id:
+                text += "\n\n⚠️ ID неизвестен: в Telegram бан не снят, снимите его вручную"
+            await reply(update, text)
+        elif banned_in_chat:
+            await reply(update, f"✅ Бан @{target_username} в Telegram снят (в списке банов бота записи не было).")
         else:
-            await update.message.reply_text(f"❌ Пользователь @{target_username} не найден в списке банов.")
+            await reply(update, f"❌ Пользователь @{target_username} не найден в списке банов.")
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при разбане: {str(e)}")
+        await reply(update, f"❌ Ошибка при разбане: {str(e)}")
 
 @only_in_chats
 async def warn_user(update: Update, context: CallbackContext):
-    ensure_connection()
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ Только администраторы могут выдавать варны!")
-        return
-    
-    if not context.args or len(context.args) < 2:
-        await update.message.reply_text("❌ Использование: /warn @username причина")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут выдавать варны!")
         return
     
-    target_username = context.args[0]
-    reason = ' '.join(context.args[1:])
+    targets, reason = parse_targets(update, context.args or [])
     
-    if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Укажите username пользователя (начинается с @)")
+    if not targets or not reason:
+        await reply(
+            update,
+            "❌ Использование: /warn @username причина\n"
+            "Несколько целей: /warn @user1 @user2 причина\n"
+            "Или ответом на сообщение: /warn причина"
+        )
         return
     
-    target_username = target_username[1:]
+    if len(targets) > BATCH_MAX_TARGETS:
+        await reply(update, f"❌ Не больше {BATCH_MAX_TARGETS} пользователей за раз!")
+        return
     
-    if is_target_owner(target_username):
-        await update.message.reply_text("❌ Невозможно выдать варн владельцу!")
+    # Варны считаются по username, цели без него пропускаем
+    no_username = [target for target in targets if not target[1]]
+    targets, owners = await split_owners(await resolve_targets([target for target in targets if target[1]]))
+    if not targets:
+        if owners:
+            await reply(update, "❌ Невозможно выдать варн владельцу!")
+        else:
+            await reply(update, "❌ Укажите username пользователя (начинается с @)")
         return
     
+    ban_reason = f"Автобан за {WARN_LIMIT} варна (последний: {reason})"
+    rows = [(target_id, username, reason, user_id, chat_id, WARN_LIMIT, ban_reason) for target_id, username in targets]
+    
     try:
-        cursor.execute("INSERT INTO warns (user_id, username, reason, warned_by, chat_id) VALUES (%s, %s, %s, %s, %s)",
-                      (0, target_username, reason, user_id, chat_id))
-        conn.commit()
-        
-        cursor.execute("SELECT COUNT(*) FROM warns WHERE username = %s", (target_username,))
-        warn_count = cursor.fetchone()[0]
-        
-        await update.message.reply_text(
-            f"⚠️ Пользователь @{target_username} получил варн!\n"
-            f"Причина: {reason}\n"
-            f"Всего варнов: {warn_count}/3"
-        )
-        
-        if warn_count >= 3:
-            cursor.execute("INSERT INTO bans (user_id, username, reason, banned_by, chat_id) VALUES (%s, %s, %s, %s, %s)",
-                          (0, target_username, f"Автобан за 3 варна (последний: {reason})", user_id, chat_id))
-            cursor.execute("DELETE FROM warns WHERE username = %s", (target_username,))
-            conn.commit()
+        if len(targets) == 1 and not owners and not no_username:
+            target_id, target_username = targets[0]
+            warn_count, banned = await add_warn(target_id, target_username, reason, user_id, chat_id)
             
-            await update.message.reply_text(
-                f"🚨 АВТОМАТИЧЕСКИЙ БАН!\n"
-                f"Пользователь @{target_username} получил бан за 3 вана.\n"
-                f"Причина последнего варна: {reason}"
+            await reply(
+                update,
+                f"⚠️ Пользователь @{target_username} получил варн!\n"
+                f"Причина: {reason}\n"
+                f"Всего варнов: {warn_count}/{WARN_LIMIT}"
             )
+            
+            if banned:
+                if target_id:
+                    await ban_in_telegram(context.bot, chat_id, [target_id])
+                await reply(
+                    update,
+                    f"🚨 АВТОМАТИЧЕСКИЙ БАН!\n"
+                    f"Пользователь @{target_username} получил бан за {WARN_LIMIT} вана.\n"
+                    f"Причина последнего варна: {reason}"
+                )
+            return
+        
+        results = await db_run(_add_warns, rows, write=True)
+        banned_names = {username.lower() for username, _, banned in results if banned}
+        await ban_in_telegram(context.bot, chat_id, [
+            target_id for target_id, username in targets if target_id and username.lower() in banned_names
+        ])
         
+        text = f"⚠️ Выдано варнов: {len(results)}\nПричина: {reason}\n\n"
+        for username, warn_count, banned in results:
+            text += f"• @{username}: {warn_count}/{WARN_LIMIT}" + (" — 🚨 автобан" if banned else "") + "\n"
+        if owners:
+            text += "\n👑 Пропущены владельцы: " + ", ".join(target_label(target) for target in owners)
+        if no_username:
+            text += "\n❔ Пропущены без username: " + ", ".join(target_label(target) for target in no_username)
+        await reply(update, text)
+        
+    except DB_OUTAGE_ERRORS as e:
+        # Число варнов и автобан посчитает база, когда применит журнал
+        if not await journal_write(e, 'warn', rows):
+            await reply(update, f"❌ Ошибка при выдаче варна: {str(e)}")
+            return
+        names = ", ".join(f"@{username}" for _, username in targets)
+        await reply(update, f"⚠️ Варн: {names}\nПричина: {reason}" + JOURNAL_NOTE)
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при выдаче варна: {str(e)}")
+        await reply(update, f"❌ Ошибка при выдаче варна: {str(e)}")
 
 @only_in_chats
 async def mute_user(update: Update, context: CallbackContext):
-    ensure_connection()
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
-    if not is_admin(user_id):
-        await update.message.reply_text("❌ Только администраторы могут мутить пользователей!")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут мутить пользователей!")
         return
     
     if not context.args or len(context.args) < 3:
-        await update.message.reply_text("❌ Использование: /mute @username время причина\n\nПримеры:\n/mute @username 1h Флуд\n/mute @username 30m Спам")
+        await reply(update, "❌ Использование: /mute @username время причина\n\nПримеры:\n/mute @username 1h Флуд\n/mute @username 30m Спам")
         return
     
     target_username = context.args[0]
@@ -580,128 +3046,395 @@ async def mute_user(update: Update, context: CallbackContext):
     reason = ' '.join(context.args[2:])
     
     if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Укажите username пользователя (начинается с @)")
+        await reply(update, "❌ Укажите username пользователя (начинается с @)")
         return
     
     target_username = target_username[1:]
     
-    if is_target_owner(target_username):
-        await update.message.reply_text("❌ Невозможно замутить владельца!")
+    seconds = parse_duration(mute_time)
+    if seconds is None:
+        await reply(update, "❌ Неверное время мута! Примеры: 30m, 1h, 1d (не больше 366 дней)")
+        return
+    
+    if await is_target_owner(target_username):
+        await reply(update, "❌ Невозможно замутить владельца!")
         return
     
     try:
-        # Просто добавляем в базу без реального мута
-        cursor.execute("INSERT INTO mutes (user_id, username, reason, muted_by, chat_id) VALUES (%s, %s, %s, %s, %s)",
-                      (0, target_username, f"{reason} (время: {mute_time})", user_id, chat_id))
-        conn.commit()
+        [(target_id, _)] = await resolve_targets([(0, target_username)])
+        try:
+            await add_mute(target_id, target_username, reason, user_id, chat_id, seconds)
+            note = ""
+        except DB_OUTAGE_ERRORS as e:
+            # Ограничение в Telegram снимется само по until_date, снятие в базе — после журнала
+            if not await journal_write(e, 'mute', target_id, target_username, reason, user_id, chat_id, seconds, time.time()):
+                raise
+            note = JOURNAL_NOTE
         
-        await update.message.reply_text(f"🔇 Пользователь @{target_username} замьючен на {mute_time}!\nПричина: {reason}")
+        text = f"🔇 Пользователь @{target_username} замьючен на {mute_time}!\nПричина: {reason}"
+        if target_id:
+            try:
+                await context.bot.restrict_chat_member(
+                    chat_id, target_id, ChatPermissions.no_permissions(), until_date=int(time.time()) + seconds
+                )
+            except Exception as e:
+                logging.warning("Не удалось ограничить %s в %s: %s", target_id, chat_id, e)
+                text += "\n\n⚠️ Не удалось ограничить в Telegram"
+        await reply(update, text + note)
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при муте: {str(e)}")
+        await reply(update, f"❌ Ошибка при муте: {str(e)}")
+
+async def track_users(update: Update, context: CallbackContext):
+    """Последняя группа обработчиков: запоминает авторов сообщений для справочника"""
+    chat_id = update.effective_chat.id
+    if chat_id not in known_chats:
+        known_chats.add(chat_id)
+        start_background(discover_chat(context.bot, update.effective_chat))
+    if update.effective_user:
+        user_directory.remember(chat_id, update.effective_user)
+    reply = update.effective_message.reply_to_message
+    if reply and reply.from_user:
+        user_directory.remember(chat_id, reply.from_user)
+
+async def screen_new_members(update: Update, context: CallbackContext):
+    """Вход в чат: новички попадают в справочник и, если проверка включена, в окно проверки"""
+    chat_id = update.effective_chat.id
+    members = update.message.new_chat_members
+    for member in members:
+        user_directory.remember(chat_id, member)
+    mode = await get_screening_mode(chat_id)
+    if mode != 'off':
+        join_screener.add(context.bot, chat_id, mode, [member for member in members if not member.is_bot])
 
 @only_in_chats
-async def add_owner(update: Update, context: CallbackContext):
-    ensure_connection()
+async def screening_command(update: Update, context: CallbackContext):
+    chat_id = update.effective_chat.id
+    
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут настраивать проверку новых участников!")
+        return
+    
+    if not context.args:
+        mode = await get_screening_mode(chat_id)
+        await reply(
+            update,
+            f"🚪 Проверка новых участников: {mode}\n\n"
+            "Использование: /screening off|alert|ban\n"
+            "• off - Не проверять\n"
+            "• alert - Сообщать о скамерах из базы\n"
+            "• ban - Сразу банить скамеров из базы"
+        )
+        return
+    
+    mode = context.args[0].lower()
+    if mode not in SCREENING_MODES:
+        await reply(update, "❌ Режим должен быть одним из: off, alert, ban")
+        return
+    
+    await set_screening_mode(chat_id, update.effective_chat.title, mode)
+    await reply(update, f"✅ Проверка новых участников: {mode}")
+
+@only_in_chats
+async def global_ban(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут банить пользователей!")
+        return
+    
+    targets, reason = parse_targets(update, context.args or [])
+    
+    if len(targets) != 1 or not reason:
+        await reply(
+            update,
+            "❌ Использование: /gban @username причина\n"
+            "Или ответом на сообщение: /gban причина\n"
+            "Бан во всех чатах, где бот администратор"
+        )
+        return
+    
+    targets, owners = await split_owners(await resolve_targets(targets))
+    if owners:
+        await reply(update, "❌ Невозможно забанить владельца!")
+        return
+    
+    target_id, username = targets[0]
+    if not target_id:
+        await reply(update, f"❌ ID {target_label(targets[0])} неизвестен. Укажите ID или ответьте на сообщение пользователя.")
+        return
+    
+    try:
+        ban_id, total = await db_run(_create_global_ban, target_id, username, reason, user_id, chat_id, write=True)
+        if not total:
+            await db_run(_global_ban_counts, ban_id, write=True)
+            await reply(update, "❌ Нет чатов, где бот администратор с правом банить.")
+            return
+        
+        ban = (target_id, username, reason)
+        try:
+            message = await reply(update, format_global_ban(ban, {'pending': total}), wait=True)
+            await db_execute("UPDATE global_bans SET progress_message_id = %s WHERE id = %s", (message.message_id, ban_id))
+        except Exception as e:
+            # Без сообщения о ходе итог придет отдельным сообщением
+            logging.warning("Не удалось отправить ход глобального бана #%s: %s", ban_id, e)
+        global_bans.start(context.bot, ban_id)
+        
+    except Exception as e:
+        await reply(update, f"❌ Ошибка при бане: {str(e)}")
+
+async def track_bot_status(update: Update, context: CallbackContext):
+    """Бота добавили, повысили, понизили или удалили из чата"""
+    change = update.my_chat_member
+    if change.chat.type == 'private':
+        return
+    await set_bot_status(change.chat.id, change.chat.title, change.new_chat_member)
+
+# 📄 ПОСТРАНИЧНЫЕ СПИСКИ
+PAGE_SIZE = 10
+# Причина длиннее обрезается: страница из PAGE_SIZE строк должна влезть в 4096 символов
+PAGE_REASON_LIMIT = 300
+# callback_data ограничена 64 байтами, поэтому username для кнопок /warns хранится
+# здесь, а в кнопку идет короткий ключ. После перезапуска старые кнопки устаревают.
+PAGE_KEYS_MAX = 1000
+page_keys = OrderedDict()
+page_key_ids = itertools.count(1)
+
+def page_key(value):
+    """Короткий ключ для значения в callback_data"""
+    key = format(next(page_key_ids), 'x')
+    page_keys[key] = value
+    if len(page_keys) > PAGE_KEYS_MAX:
+        page_keys.popitem(last=False)
+    return key
+
+def short_reason(reason):
+    return reason if len(reason) <= PAGE_REASON_LIMIT else reason[:PAGE_REASON_LIMIT - 1] + "…"
+
+async def fetch_page(query, params, direction=None, cursor_id=None):
+    """Keyset-страница по id: (строки от новых к старым, есть новее, есть старее).
+    
+    query — SELECT id, ... с WHERE; direction 'next' идет к более старым записям
+    от cursor_id, 'prev' — к более новым.
+    """
+    if direction == 'next':
+        rows = await db_fetchall(query + " AND id < %s ORDER BY id DESC LIMIT %s", params + (cursor_id, PAGE_SIZE + 1), readonly=True)
+        return rows[:PAGE_SIZE], True, len(rows) > PAGE_SIZE
+    if direction == 'prev':
+        rows = await db_fetchall(query + " AND id > %s ORDER BY id ASC LIMIT %s", params + (cursor_id, PAGE_SIZE + 1), readonly=True)
+        return rows[:PAGE_SIZE][::-1], len(rows) > PAGE_SIZE, True
+    rows = await db_fetchall(query + " ORDER BY id DESC LIMIT %s", params + (PAGE_SIZE + 1,), readonly=True)
+    return rows[:PAGE_SIZE], False, len(rows) > PAGE_SIZE
+
+def page_keyboard(prefix, rows, has_newer, has_older):
+    """Кнопки навигации; callback_data: '<prefix>:<prev|next>:<id>'"""
+    buttons = []
+    if rows and has_newer:
+        buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"{prefix}:prev:{rows[0][0]}"))
+    if rows and has_older:
+        buttons.append(InlineKeyboardButton("Старее ➡️", callback_data=f"{prefix}:next:{rows[-1][0]}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+BANLIST_QUERY = "SELECT id, username, user_id, reason, ban_date FROM bans WHERE chat_id = %s"
+WARNS_QUERY = "SELECT id, reason, warn_date FROM warns WHERE chat_id = %s AND LOWER(username) = LOWER(%s)"
+
+async def render_banlist(chat_id, direction=None, cursor_id=None):
+    rows, has_newer, has_older = await fetch_page(BANLIST_QUERY, (chat_id,), direction, cursor_id)
+    if not rows:
+        return "📋 Список банов пуст", None
+    
+    text = "🔨 СПИСОК БАНОВ:\n\n"
+    for _, username, user_id, reason, ban_date in rows:
+        target = f"@{username}" if username else f"ID {user_id}"
+        text += f"• {target} — {short_reason(reason)} ({ban_date:%d.%m.%Y})\n"
+    return text, page_keyboard("banlist", rows, has_newer, has_older)
+
+async def render_warns(chat_id, username, direction=None, cursor_id=None, key=None):
+    rows, has_newer, has_older = await fetch_page(WARNS_QUERY, (chat_id, username), direction, cursor_id)
+    if not rows:
+        return f"✅ У @{username} нет варнов в этом чате", None
+    
+    text = f"⚠️ ВАРНЫ @{username}:\n\n"
+    for _, reason, warn_date in rows:
+        text += f"• {short_reason(reason)} ({warn_date:%d.%m.%Y %H:%M})\n"
+    return text, page_keyboard(f"warns:{key or page_key(username)}", rows, has_newer, has_older)
+
+@only_in_chats
+async def banlist(update: Update, context: CallbackContext):
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут просматривать список банов!")
+        return
+    
+    text, keyboard = await render_banlist(update.effective_chat.id)
+    await reply(update, text, reply_markup=keyboard)
+
+@only_in_chats
+async def list_warns(update: Update, context: CallbackContext):
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут просматривать варны!")
+        return
+    
+    # Username в Telegram — не длиннее 32 символов
+    if not context.args or not context.args[0].startswith('@') or len(context.args[0]) > 33:
+        await reply(update, "❌ Использование: /warns @username")
+        return
+    
+    text, keyboard = await render_warns(update.effective_chat.id, context.args[0][1:])
+    await reply(update, text, reply_markup=keyboard)
+
+async def page_callback(update: Update, context: CallbackContext):
+    """Кнопки ⬅️/➡️ под /banlist и /warns"""
+    query = update.callback_query
+    if not await caller_is_admin(update, context):
+        await query.answer("❌ Только для администраторов", show_alert=True)
+        return
+    
+    parts = query.data.split(':')
+    chat_id = query.message.chat.id
+    direction, cursor_id = parts[-2], int(parts[-1])
+    if parts[0] == 'banlist':
+        text, keyboard = await render_banlist(chat_id, direction, cursor_id)
+    else:
+        username = page_keys.get(parts[1])
+        if username is None:
+            await query.answer("⌛ Список устарел, вызовите /warns еще раз", show_alert=True)
+            return
+        page_keys.move_to_end(parts[1])
+        text, keyboard = await render_warns(chat_id, username, direction, cursor_id, key=parts[1])
+    
+    await query.answer()
+    # Правка страницы — через очередь отправки: темп чата и повтор на 429
+    outbound.send(
+        query.get_bot(), chat_id, method='edit_message_text',
+        message_id=query.message.message_id, text=text, reply_markup=keyboard
+    )
+
+@only_in_chats
+async def unmute_user(update: Update, context: CallbackContext):
+    chat_id = update.effective_chat.id
     
-    if not is_owner(user_id):
-        await update.message.reply_text("❌ Только владелец бота может добавлять других владельцев!")
+    if not await caller_is_admin(update, context):
+        await reply(update, "❌ Только администраторы могут размучивать пользователей!")
+        return
+    
+    if not context.args or not context.args[0].startswith('@'):
+        await reply(update, "❌ Использование: /unmute @username")
+        return
+    
+    target_username = context.args[0][1:]
+    
+    try:
+        # Запись из кучи планировщика не удаляем: DELETE по ней просто ничего не найдет
+        lifted = await db_fetchall(
+            "DELETE FROM mutes WHERE chat_id = %s AND LOWER(username) = LOWER(%s) RETURNING user_id",
+            (chat_id, target_username), write=True
+        )
+        failed = 0
+        for (target_id,) in lifted:
+            if target_id:
+                try:
+                    await context.bot.restrict_chat_member(chat_id, target_id, ChatPermissions.all_permissions())
+                except Exception as e:
+                    logging.warning("Не удалось снять ограничения с %s в %s: %s", target_id, chat_id, e)
+                    failed += 1
+        
+        if lifted and failed:
+            await reply(update, f"⚠️ Мут @{target_username} снят в базе, но снять ограничения в Telegram не удалось.")
+        elif lifted:
+            await reply(update, f"🔊 Пользователь @{target_username} размьючен!")
+        else:
+            await reply(update, f"❌ Пользователь @{target_username} не найден в списке мутов.")
+        
+    except Exception as e:
+        await reply(update, f"❌ Ошибка при размуте: {str(e)}")
+
+@only_in_chats
+async def add_owner(update: Update, context: CallbackContext):
+    if not await caller_is_owner(update, context):
+        await reply(update, "❌ Только владелец бота может добавлять других владельцев!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Использование: /add_owner user_id @username\n\nПример:\n/add_owner 123456789 @username")
+        await reply(update, "❌ Использование: /add_owner user_id @username\n\nПример:\n/add_owner 123456789 @username")
         return
     
     if len(context.args) < 2:
-        await update.message.reply_text("❌ Нужно указать ID и username!\nИспользование: /add_owner user_id @username")
+        await reply(update, "❌ Нужно указать ID и username!\nИспользование: /add_owner user_id @username")
         return
     
     target_id = context.args[0]
     target_username = context.args[1]
     
     if not target_id.isdigit():
-        await update.message.reply_text("❌ ID должен быть числом!")
+        await reply(update, "❌ ID должен быть числом!")
         return
     
     target_id = int(target_id)
     
     if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Username должен начинаться с @!")
+        await reply(update, "❌ Username должен начинаться с @!")
         return
     
     target_username = target_username[1:]
     
     try:
-        cursor.execute("SELECT 1 FROM admins WHERE admin_id = %s OR username = %s", (target_id, target_username))
-        if cursor.fetchone():
-            await update.message.reply_text("❌ Этот пользователь уже есть в базе администраторов!")
+        if not await db_run(_insert_admin, target_id, target_username, 'owner', write=True):
+            await reply(update, "❌ Этот пользователь уже есть в базе администраторов!")
             return
+        role_cache.invalidate()
         
-        cursor.execute("INSERT INTO admins (admin_id, username, role) VALUES (%s, %s, 'owner')",
-                      (target_id, target_username))
-        conn.commit()
-        
-        await update.message.reply_text(f"✅ Владелец добавлен!\n👤 ID: {target_id}\n📱 Username: @{target_username}")
+        await reply(update, f"✅ Владелец добавлен!\n👤 ID: {target_id}\n📱 Username: @{target_username}")
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при добавлении владельца: {str(e)}")
+        await reply(update, f"❌ Ошибка при добавлении владельца: {str(e)}")
 
 @only_in_chats
 async def add_admin(update: Update, context: CallbackContext):
-    ensure_connection()
-    user_id = update.effective_user.id
-    
-    if not is_owner(user_id):
-        await update.message.reply_text("❌ Только владелец бота может добавлять администраторов!")
+    if not await caller_is_owner(update, context):
+        await reply(update, "❌ Только владелец бота может добавлять администраторов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Использование: /add_admin user_id @username\n\nПример:\n/add_admin 123456789 @username")
+        await reply(update, "❌ Использование: /add_admin user_id @username\n\nПример:\n/add_admin 123456789 @username")
         return
     
     if len(context.args) < 2:
-        await update.message.reply_text("❌ Нужно указать ID и username!\nИспользование: /add_admin user_id @username")
+        await reply(update, "❌ Нужно указать ID и username!\nИспользование: /add_admin user_id @username")
         return
     
     target_id = context.args[0]
     target_username = context.args[1]
     
     if not target_id.isdigit():
-        await update.message.reply_text("❌ ID должен быть числом!")
+        await reply(update, "❌ ID должен быть числом!")
         return
     
     target_id = int(target_id)
     
     if not target_username.startswith('@'):
-        await update.message.reply_text("❌ Username должен начинаться с @!")
+        await reply(update, "❌ Username должен начинаться с @!")
         return
     
     target_username = target_username[1:]
     
     try:
-        cursor.execute("SELECT 1 FROM admins WHERE admin_id = %s OR username = %s", (target_id, target_username))
-        if cursor.fetchone():
-            await update.message.reply_text("❌ Этот пользователь уже есть в базе администраторов!")
+        if not await db_run(_insert_admin, target_id, target_username, 'admin', write=True):
+            await reply(update, "❌ Этот пользователь уже есть в базе администраторов!")
             return
+        role_cache.invalidate()
         
-        cursor.execute("INSERT INTO admins (admin_id, username, role) VALUES (%s, %s, 'admin')",
-                      (target_id, target_username))
-        conn.commit()
-        
-        await update.message.reply_text(f"✅ Администратор добавлен!\n👤 ID: {target_id}\n📱 Username: @{target_username}")
+        await reply(update, f"✅ Администратор добавлен!\n👤 ID: {target_id}\n📱 Username: @{target_username}")
         
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка при добавлении администратора: {str(e)}")
+        await reply(update, f"❌ Ошибка при добавлении администратора: {str(e)}")
 
 @only_in_chats
 async def list_admins(update: Update, context: CallbackContext):
-    ensure_connection()
-    cursor.execute("SELECT admin_id, username, role FROM admins ORDER BY role DESC, username")
-    admins = cursor.fetchall()
+    admins = await db_fetchall("SELECT admin_id, username, role FROM admins ORDER BY role DESC, username", readonly=True)
     
     if not admins:
-        await update.message.reply_text("📋 Список администраторов пуст")
+        await reply(update, "📋 Список администраторов пуст")
         return
     
     text = "👑 ВЛАДЕЛЬЦЫ:\n"
@@ -716,14 +3449,341 @@ async def list_admins(update: Update, context: CallbackContext):
         admin_id, username, role = admin
         text += f"• ID: `{admin_id}`" + (f" | @{username}" if username else " | username не указан") + "\n"
     
-    await update.message.reply_text(text, parse_mode='Markdown')
+    await reply(update, text, parse_mode='Markdown')
+
+@only_in_chats
+async def import_scammers(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    
+    if not await caller_is_owner(update, context):
+        await reply(update, "❌ Только владелец бота может импортировать скамеров!")
+        return
+    
+    message = update.message
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if not document:
+        await reply(
+            update,
+            "❌ Использование: отправьте /import_scammers ответом на CSV/JSONL файл "
+            "или в подписи к нему.\n\n"
+            "Поля: user_id, username, proof, scam_type"
+        )
+        return
+    
+    file_name = (document.file_name or '').lower()
+    file_format = 'jsonl' if file_name.endswith(('.jsonl', '.ndjson')) else 'csv'
+    
+    try:
+        telegram_file = await document.get_file()
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as raw_file:
+            await telegram_file.download_to_memory(out=raw_file)
+            raw_file.seek(0)
+            total, invalid, inserted = await db_run(_import_scammers, raw_file, file_format, user_id, write=True)
+        
+        if scammer_index:
+            await scammer_index.refresh()
+        
+        await reply(
+            update,
+            f"✅ Импорт завершен!\n\n"
+            f"📄 Строк в файле: {total}\n"
+            f"🆕 Добавлено: {inserted}\n"
+            f"🔁 Пропущено (уже в базе или повтор): {total - invalid - inserted}\n"
+            f"⚠️ С ошибками: {invalid}"
+        )
+        
+    except Exception as e:
+        await reply(update, f"❌ Ошибка при импорте: {str(e)}")
+
+@only_in_chats
+async def export_scammers(update: Update, context: CallbackContext):
+    if not await caller_is_owner(update, context):
+        await reply(update, "❌ Только владелец бота может выгружать базу скамеров!")
+        return
+    
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b') as out_file:
+            await db_run(_export_scammers, out_file, readonly=True)
+            out_file.seek(0)
+            # Файл закроется при выходе из with, поэтому ждем отправки
+            await reply(
+                update,
+                method='send_document',
+                document=out_file,
+                filename=f"scammers_{datetime.now():%Y%m%d}.csv",
+                caption="📦 Выгрузка базы скамеров",
+                wait=True
+            )
+        
+    except Exception as e:
+        await reply(update, f"❌ Ошибка при выгрузке: {str(e)}")
+
+# 🌐 ВСТРОЕННЫЙ HTTP СЕРВЕР
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_READ_TIMEOUT = 10
+
+async def _read_http_request(reader):
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > HTTP_MAX_BODY:
+        raise OverflowError(length)
+    body = await reader.readexactly(length) if length else b''
+    return method, target.split('?', 1)[0], headers, body
+
+async def start_http_server(host, port, routes):
+    """Минимальный HTTP/1.1 сервер.
+    
+    routes: {(method, path): async handler(headers, body) -> (status, content_type, payload)}
+    """
+    async def handle(reader, writer):
+        content_type, payload = 'text/plain; charset=utf-8', b''
+        try:
+            method, path, headers, body = await asyncio.wait_for(_read_http_request(reader), HTTP_READ_TIMEOUT)
+            route = routes.get((method, path))
+            if route is None:
+                status = 404
+            else:
+                status, content_type, payload = await route(headers, body)
+        except OverflowError:
+            status = 413
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            status = 400
+        except Exception:
+            logging.exception("Ошибка HTTP обработчика")
+            status = 500
+        
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    return await asyncio.start_server(handle, host, port)
+
+# 📈 МЕТРИКИ: ОБРАБОТЧИКИ И HTTP
+def timed_handler(name, callback):
+    """Обертка обработчика: счетчик вызовов и гистограмма времени по команде"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        labels = (('command', name),)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = await callback(update, context)
+            status = 'ok'
+            return result
+        except ApplicationHandlerStop:
+            status = 'stopped'
+            raise
+        finally:
+            metrics.observe('bot_command_duration_seconds', time.perf_counter() - started, labels)
+            metrics.inc('bot_commands_total', labels + (('status', status),))
+    return wrapper
+
+def instrument_handlers(application: Application):
+    """Обернуть все зарегистрированные обработчики метриками"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                name = sorted(handler.commands)[0]
+            else:
+                name = handler.callback.__name__
+            handler.callback = timed_handler(name, handler.callback)
+
+async def event_loop_lag_loop():
+    """Насколько позже срока просыпается задача — показатель загрузки цикла событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(loop.time() - expected, 0)
+        metrics.observe('event_loop_lag_seconds', lag)
+        metrics.set('event_loop_lag_last_seconds', lag)
+
+async def metrics_route(headers, body):
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+
+async def start_metrics_server():
+    server = await start_http_server(METRICS_LISTEN, METRICS_PORT, {('GET', '/metrics'): metrics_route})
+    print(f"📈 Метрики: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    try:
+        await asyncio.Future()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+# 🪝 WEBHOOK
+def webhook_route(application: Application):
+    """Принимает Update JSON и кладет его в очередь приложения"""
+    async def handle_update(headers, body):
+        if WEBHOOK_SECRET:
+            token = headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+                return 403, 'text/plain; charset=utf-8', b'forbidden'
+        data = json.loads(body)
+        # Валидный JSON, но не Update (список, число, объект без update_id) — 400, а не 500
+        if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+            raise ValueError("ожидался объект Update")
+        update = Update.de_json(data, application.bot)
+        await application.update_queue.put(update)
+        return 200, 'text/plain; charset=utf-8', b'ok'
+    return handle_update
+
+def check_webhook_config():
+    """Без WEBHOOK_SECRET любой, кто достучится до порта, подделает Update от владельца"""
+    if WEBHOOK_SECRET:
+        return
+    try:
+        loopback = WEBHOOK_LISTEN == 'localhost' or ipaddress.ip_address(WEBHOOK_LISTEN).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ValueError(f"❌ WEBHOOK_SECRET не установлен, а webhook слушает {WEBHOOK_LISTEN}!")
+
+async def run_webhook(application: Application):
+    """Webhook режим: обновления приходят POST-запросами на WEBHOOK_PATH"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    # run_polling сам вызывает post_init/post_stop/post_shutdown, здесь это делаем мы
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    server = await start_http_server(WEBHOOK_LISTEN, WEBHOOK_PORT, {('POST', WEBHOOK_PATH): webhook_route(application)})
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+        print(f"✅ Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+background_tasks = set()
+
+def start_background(coro):
+    """Запустить фоновую задачу, которая будет отменена при остановке"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    # Завершившиеся задачи (discover_chat, рассылки /gban) не копятся
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def post_init(application: Application):
+    """Фоновые задачи после запуска цикла событий"""
+    start_background(prepare_db())
+    if STATUS_CARDS_ENABLED:
+        load_status_fonts()
+    if METRICS_ENABLED:
+        metrics.set('db_available', 1)
+        start_background(start_metrics_server())
+        start_background(event_loop_lag_loop())
+    start_background(db_health_loop())
+    start_background(listen_admin_changes())
+    if scammer_index:
+        start_background(scammer_index_loop())
+    start_background(mute_scheduler.run(application))
+    start_background(user_directory.run())
+    start_background(global_bans.resume(application))
+    if DEGRADED_MODE:
+        start_background(snapshot_loop())
+        start_background(journal_replay_loop(application))
+    if DATABASE_READ_URL:
+        start_background(replica_monitor_loop())
+
+async def error_handler(update: object, context: CallbackContext):
+    """Сбой БД не роняет обработчики: пользователь получает короткий ответ"""
+    # CommitUnknown — запись могла пройти, "попробуйте позже" тут вводит в заблуждение
+    error = context.error
+    if isinstance(error, DB_OUTAGE_ERRORS + (DatabaseBusy,)) and not isinstance(error, CommitUnknown):
+        if isinstance(update, Update) and update.effective_message:
+            await reply(update, "⚠️ База данных временно недоступна, попробуйте позже.")
+        return
+    logging.error("Ошибка при обработке обновления", exc_info=context.error)
+
+async def post_stop(application: Application):
+    """Бот еще может отправлять: дописываем очередь сообщений"""
+    if not await outbound.drain(SEND_DRAIN_TIMEOUT):
+        logging.warning("Очередь отправки не опустела за %s с", SEND_DRAIN_TIMEOUT)
+
+async def post_shutdown(application: Application):
+    """Останавливаем фоновые задачи и закрываем пул соединений"""
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    background_tasks.clear()
+    await user_directory.flush()
+    close_pool()
+    close_pool(readonly=True)
+    db_executor.shutdown(wait=False)
+    if db_read_executor:
+        db_read_executor.shutdown(wait=False)
+    render_executor.shutdown(wait=False)
+    if write_journal:
+        # Дописываем журнал до конца: о записях уже ответили в чат
+        write_journal.executor.shutdown(wait=True)
 
 def main():
     """Основная функция запуска"""
     print("🔄 Создаем application...")
+    # Подключение к БД идет в фоне, но без DATABASE_URL запускаться нет смысла
+    get_connection_params()
+    if BOT_MODE == 'webhook':
+        check_webhook_config()
     
     # Создаем application
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .context_types(ContextTypes(context=BotContext))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if BOT_MODE == 'webhook':
+        builder = builder.updater(None)
+    application = builder.build()
     
     # ДОБАВЛЯЕМ ВСЕ КОМАНДЫ
     application.add_handler(CommandHandler("start", start))
@@ -731,26 +3791,49 @@ def main():
     application.add_handler(CommandHandler("check", check_user))
     application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("ban", ban_user))
+    application.add_handler(CommandHandler("gban", global_ban))
     application.add_handler(CommandHandler("unban", unban_user))
     application.add_handler(CommandHandler("warn", warn_user))
     application.add_handler(CommandHandler("mute", mute_user))
+    application.add_handler(CommandHandler("unmute", unmute_user))
+    application.add_handler(CommandHandler("warns", list_warns))
+    application.add_handler(CommandHandler("banlist", banlist))
+    application.add_handler(CallbackQueryHandler(page_callback, pattern=r'^(banlist|warns):'))
     application.add_handler(CommandHandler("add_scammer", add_scammer))
     application.add_handler(CommandHandler("add_owner", add_owner))
     application.add_handler(CommandHandler("add_admin", add_admin))
     application.add_handler(CommandHandler("list_admins", list_admins))
-    
-    print("✅ Application создан, запускаем polling...")
+    application.add_handler(CommandHandler("import_scammers", import_scammers))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/import_scammers\b'), import_scammers))
+    application.add_handler(CommandHandler("export_scammers", export_scammers))
+    application.add_handler(CommandHandler("screening", screening_command))
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, screen_new_members))
+    application.add_handler(ChatMemberHandler(track_bot_status, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_error_handler(error_handler)
+    if METRICS_ENABLED:
+        instrument_handlers(application)
+    
+    # Лимиты проверяются в группе -1, раньше любых команд
+    bot_commands.update(
+        command for handler in application.handlers[0] if isinstance(handler, CommandHandler)
+        for command in handler.commands
+    )
+    application.add_handler(TypeHandler(Update, resolve_caller), group=-2)
+    application.add_handler(TypeHandler(Update, rate_limit_guard), group=-1)
+    # Справочник пользователей пополняется из всех сообщений в группах, после команд
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS, track_users), group=USER_TRACKING_GROUP)
     
     # Запускаем бота
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        print("✅ Application создан, запускаем webhook...")
+        asyncio.run(run_webhook(application))
+    else:
+        print("✅ Application создан, запускаем polling...")
+        application.run_polling()
 
 if __name__ == '__main__':
     print("🚀 Запускаем бота...")
     
-    # Инициализация БД
-    init_db()
-    print("📊 База данных инициализирована")
-    
-    # Запуск
+    # Запуск; миграции и подключение к БД — в фоне из post_init
     main()
 